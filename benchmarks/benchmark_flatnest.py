@@ -0,0 +1,226 @@
+"""
+Benchmarks of the flatnest functions over generated nested structures of controlled shape and size
+
+Run from the repository root, e.g.
+
+    python benchmarks/benchmark_flatnest.py --sizes 1000,100000,10000000 --output results.json
+    python benchmarks/benchmark_flatnest.py --output new.json --compare results.json
+
+Each result records the shape, the number of leaves, the function, the number of calls per timing and the best and all timings in seconds.
+With --compare, results slower than the baseline by more than --threshold are listed and the exit status is 1.
+"""
+
+import argparse
+import gc
+import json
+import os.path
+import platform
+import random
+import sys
+import time
+sys.path.insert(0,os.path.abspath(os.path.join(os.path.dirname(__file__),'../src')))
+import flatnest
+from flatnest import bfs, convert_bfs_to_dfs, convert_dfs_to_bfs, convert_flat_index_bfs_to_dfs, convert_flat_index_dfs_to_bfs, deflatten, dfs, flatten, get_flat_index, get_nested_indices, parse_pattern
+
+def wide_flat(size,rng):
+    """
+    A single list of size values
+    """
+    return list(range(size))
+
+def deep_narrow(size,rng):
+    """
+    A chain of nested lists, each holding two values and the next nested list
+    """
+    top = []
+    nested_structure = top
+    for value in range(0,size-1,2):
+        child = []
+        nested_structure.extend([value,value+1,child])
+        nested_structure = child
+    if size % 2 == 1:
+        nested_structure.append(size-1)
+    return top
+
+def _ragged(size,rng,make_value):
+    top = []
+    stack = [top]
+    for value in range(size):
+        roll = rng.random()
+        if roll < 0.1 and len(stack) < 20:
+            stack[-1].append([])
+            stack.append(stack[-1][-1])
+        elif roll < 0.2 and len(stack) > 1:
+            stack.pop()
+        stack[-1].append(make_value(value))
+    return top
+
+def ragged(size,rng):
+    """
+    Randomly nested lists of random lengths, up to 20 levels deep
+    """
+    return _ragged(size,rng,lambda value: value)
+
+def rectangular(size,rng):
+    """
+    A list of rows of equal length, as close to square as size allows
+    """
+    width = max(1,int(size**0.5))
+    rows = [list(range(start,min(start+width,size))) for start in range(0,size,width)]
+    return rows
+
+def mixed(size,rng):
+    """
+    ragged, with values of mixed types (int, float, str, bytes, None)
+    """
+    kinds = [lambda value: value, float, str, lambda value: str(value).encode('ascii'), lambda value: None]
+    return _ragged(size,rng,lambda value: kinds[value % len(kinds)](value))
+
+shapes = {
+    'wide_flat': wide_flat,
+    'deep_narrow': deep_narrow,
+    'ragged': ragged,
+    'rectangular': rectangular,
+    'mixed': mixed,
+    }
+
+def _setup(nested_structure,lookups,rng):
+    """
+    Flattens the structure once and picks the indices that the index functions are timed on
+    """
+    dfs_pattern,dfs_flat_list = flatten(nested_structure,dfs)
+    bfs_pattern,bfs_flat_list = flatten(nested_structure,bfs)
+    size = len(dfs_flat_list)
+    flat_indices = [rng.randrange(size) for _ in range(lookups)] if size > 0 else []
+    return {
+        'nested_structure': nested_structure,
+        'dfs_pattern': dfs_pattern,
+        'dfs_flat_list': dfs_flat_list,
+        'bfs_pattern': bfs_pattern,
+        'bfs_flat_list': bfs_flat_list,
+        'flat_indices': flat_indices,
+        'nest_indices': [get_nested_indices(dfs_pattern,flat_index) for flat_index in flat_indices],
+        }
+
+#name: (function of the setup data, whether it is timed once per lookup)
+benchmarks = {
+    'dfs': (lambda data: list(dfs(data['nested_structure'])), False),
+    'bfs': (lambda data: list(bfs(data['nested_structure'])), False),
+    'flatten_dfs': (lambda data: flatten(data['nested_structure'],dfs), False),
+    'flatten_bfs': (lambda data: flatten(data['nested_structure'],bfs), False),
+    'deflatten_dfs': (lambda data: deflatten(data['dfs_pattern'],data['dfs_flat_list']), False),
+    'deflatten_bfs': (lambda data: deflatten(data['bfs_pattern'],data['bfs_flat_list']), False),
+    'parse_pattern_dfs': (lambda data: parse_pattern(data['dfs_pattern']), False),
+    'parse_pattern_bfs': (lambda data: parse_pattern(data['bfs_pattern']), False),
+    'convert_dfs_to_bfs': (lambda data: convert_dfs_to_bfs(data['dfs_pattern']), False),
+    'convert_bfs_to_dfs': (lambda data: convert_bfs_to_dfs(data['bfs_pattern']), False),
+    'get_nested_indices': (lambda data: [get_nested_indices(data['dfs_pattern'],flat_index) for flat_index in data['flat_indices']], True),
+    'get_flat_index': (lambda data: [get_flat_index(data['dfs_pattern'],nest_indices) for nest_indices in data['nest_indices']], True),
+    'convert_flat_index_dfs_to_bfs': (lambda data: [convert_flat_index_dfs_to_bfs(data['dfs_pattern'],flat_index) for flat_index in data['flat_indices']], True),
+    'convert_flat_index_bfs_to_dfs': (lambda data: [convert_flat_index_bfs_to_dfs(data['bfs_pattern'],flat_index) for flat_index in data['flat_indices']], True),
+    }
+
+def time_function(function,data,repeat):
+    """
+    Returns the list of the times in seconds of repeat calls of function(data)
+
+    The pattern cache is cleared before every call, so that each timing includes parsing and compiling the patterns it uses instead of reusing those of the previous call
+    """
+    times = []
+    for _ in range(repeat):
+        flatnest.pattern_cache.clear()
+        gc.collect()
+        start = time.perf_counter()
+        function(data)
+        times.append(time.perf_counter()-start)
+    return times
+
+def run(shape_names,sizes,function_names,repeat=3,lookups=100,seed=0,log=None):
+    """
+    Runs the benchmarks and returns the list of result dicts
+    """
+    results = []
+    for shape_name in shape_names:
+        for size in sizes:
+            rng = random.Random(seed)
+            data = _setup(shapes[shape_name](size,rng),lookups,rng)
+            for function_name in function_names:
+                function,per_lookup = benchmarks[function_name]
+                times = time_function(function,data,repeat)
+                result = {
+                    'shape': shape_name,
+                    'size': size,
+                    'function': function_name,
+                    'calls': (len(data['flat_indices']) if per_lookup else 1),
+                    'best': min(times),
+                    'times': times,
+                    }
+                results.append(result)
+                if log is not None:
+                    log('%-12s %10d %-32s %12.6f s' % (shape_name,size,function_name,result['best']))
+            del data
+    return results
+
+def compare(results,baseline,threshold):
+    """
+    Returns the (result, baseline result) pairs whose best time exceeds the baseline best time by more than the threshold factor
+    """
+    baseline_results = {(result['shape'],result['size'],result['function'],result['calls']): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        key = (result['shape'],result['size'],result['function'],result['calls'])
+        if key in baseline_results and result['best'] > baseline_results[key]['best']*threshold:
+            regressions.append((result,baseline_results[key]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--shapes',default=','.join(shapes),help='comma separated shapes (default: all of %(default)s)')
+    parser.add_argument('--sizes',default='1000,10000,100000',help='comma separated numbers of leaves (default: %(default)s)')
+    parser.add_argument('--functions',default=','.join(benchmarks),help='comma separated benchmarks (default: all)')
+    parser.add_argument('--repeat',type=int,default=3,help='timings per benchmark, the best is kept (default: %(default)s)')
+    parser.add_argument('--lookups',type=int,default=100,help='calls per timing of the index functions (default: %(default)s)')
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--output',help='JSON file to write the results to')
+    parser.add_argument('--compare',help='JSON file of an earlier run to compare against')
+    parser.add_argument('--threshold',type=float,default=1.2,help='slowdown factor reported as a regression (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    shape_names = args.shapes.split(',')
+    function_names = args.functions.split(',')
+    for name in shape_names:
+        if name not in shapes:
+            parser.error('unknown shape '+name)
+    for name in function_names:
+        if name not in benchmarks:
+            parser.error('unknown benchmark '+name)
+    sizes = [int(float(size)) for size in args.sizes.split(',')]
+
+    log = lambda line: print(line,file=sys.stderr)
+    results = run(shape_names,sizes,function_names,args.repeat,args.lookups,args.seed,log)
+    report = {
+        'flatnest_version': flatnest.__version__,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'arguments': vars(args),
+        'results': results,
+        }
+    if args.output is not None:
+        with open(args.output,'w') as f:
+            json.dump(report,f,indent=1)
+    else:
+        json.dump(report,sys.stdout,indent=1)
+        print()
+    if args.compare is not None:
+        with open(args.compare,'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results,baseline,args.threshold)
+        for result,baseline_result in regressions:
+            log('regression: %s %d %s %.6f s -> %.6f s' % (result['shape'],result['size'],result['function'],baseline_result['best'],result['best']))
+        return 1 if len(regressions) > 0 else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
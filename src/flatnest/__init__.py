@@ -1,2 +1,6 @@
 __version__ = '1.0.5'
 from .flatnest import *
+from .flatfile import *
+from .container import *
+from .parallel import *
+from .asyncnest import *
@@ -0,0 +1,161 @@
+"""
+This module provides asyncio counterparts of dfs, bfs and flatten
+
+Nested lists may be lists, tuples or async iterables, and any item (including the nested structure itself) may be an awaitable, which is awaited and its result used in its place.
+The traversals hand control back to the event loop every chunk of items, so that flattening a large structure does not block other tasks.
+"""
+
+import asyncio
+import inspect
+from collections import deque
+from .flatnest import NestDirective, bfs, dfs, directive_token_map
+
+#number of items handled between handing control back to the event loop, when no chunk_size is given
+ASYNC_YIELD_INTERVAL = 1000
+
+_end = object()
+
+async def _resolve(item):
+    while inspect.isawaitable(item):
+        item = await item
+    return item
+
+def _is_nested(item):
+    return isinstance(item,(list,tuple)) or hasattr(item,'__aiter__')
+
+def _iterate(nested_structure):
+    """
+    Returns an iterator (sync or async) over the items of a list, tuple or async iterable
+    """
+    if isinstance(nested_structure,(list,tuple)):
+        return iter(nested_structure)
+    return nested_structure.__aiter__()
+
+async def _next_item(iterator):
+    if hasattr(iterator,'__anext__'):
+        try:
+            return await iterator.__anext__()
+        except StopAsyncIteration:
+            return _end
+    return next(iterator,_end)
+
+async def _dfs_items(nested_structure):
+    """
+    The items and nest directives of a dfs traversal
+    """
+    stack = [_iterate(await _resolve(nested_structure))]
+    while len(stack) > 0:
+        item = await _next_item(stack[-1])
+        if item is _end:
+            stack.pop()
+            if len(stack) > 0:
+                yield NestDirective.DFS_POP
+            continue
+        item = await _resolve(item)
+        if _is_nested(item):
+            yield NestDirective.DFS_PUSH
+            stack.append(_iterate(item))
+        else:
+            yield item
+
+async def _bfs_items(nested_structure):
+    """
+    The items and nest directives of a bfs traversal
+    """
+    queue = deque([await _resolve(nested_structure)])
+    while len(queue) > 0:
+        iterator = _iterate(queue.popleft())
+        while True:
+            item = await _next_item(iterator)
+            if item is _end:
+                break
+            item = await _resolve(item)
+            if _is_nested(item):
+                yield NestDirective.BFS_QUEUE
+                queue.append(item)
+            else:
+                yield item
+        if len(queue) > 0:
+            yield NestDirective.BFS_SERVE
+
+async def _traverse(items,include_nest_directives,chunk_size):
+    handled = 0
+    chunk = []
+    async for item in items:
+        handled += 1
+        if include_nest_directives or not isinstance(item,NestDirective):
+            if chunk_size is None:
+                yield item
+            else:
+                chunk.append(item)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+        if handled == (chunk_size or ASYNC_YIELD_INTERVAL):
+            handled = 0
+            await asyncio.sleep(0)
+    if len(chunk) > 0:
+        yield chunk
+
+def async_dfs(nested_structure,include_nest_directives=False,chunk_size=None):
+    """
+    Async generator form of dfs for nested lists given as lists, tuples, async iterables or awaitables
+
+    With chunk_size, lists of up to chunk_size items (values, and nest directives if include_nest_directives) are yielded instead of single items.
+    Control goes back to the event loop after every chunk_size items handled (ASYNC_YIELD_INTERVAL without chunk_size).
+
+    >>> async def main():
+    ...     return [chunk async for chunk in async_dfs([1,[2,3,[4,5,[6,7],8,9],10,11],12],chunk_size=5)]
+    >>> asyncio.run(main())
+    [[1, 2, 3, 4, 5], [6, 7, 8, 9, 10], [11, 12]]
+
+    """
+    return _traverse(_dfs_items(nested_structure),include_nest_directives,chunk_size)
+
+def async_bfs(nested_structure,include_nest_directives=False,chunk_size=None):
+    """
+    Async generator form of bfs, see async_dfs
+
+    >>> async def row(values):
+    ...     for value in values:
+    ...         yield value
+    >>> async def main():
+    ...     return [item async for item in async_bfs([1,row([2,3]),asyncio.sleep(0,4)])]
+    >>> asyncio.run(main())
+    [1, 4, 2, 3]
+
+    """
+    return _traverse(_bfs_items(nested_structure),include_nest_directives,chunk_size)
+
+async def async_flatten(nested_structure,algorithm=dfs,chunk_size=ASYNC_YIELD_INTERVAL):
+    """
+    Coroutine form of flatten for nested lists given as lists, tuples, async iterables or awaitables
+
+    Returns the same (structure pattern, flat list) as flatten would for the resolved structure, handing control back to the event loop every chunk_size items.
+
+    >>> asyncio.run(async_flatten([1,[2,3,[4,5,[6,7],8,9],10,11],12],bfs))
+    ('1*1|2*2|2*2|2', [1, 12, 2, 3, 10, 11, 4, 5, 8, 9, 6, 7])
+
+    """
+    if algorithm in [dfs,async_dfs]:
+        items = _dfs_items(nested_structure)
+    elif algorithm in [bfs,async_bfs]:
+        items = _bfs_items(nested_structure)
+    else:
+        raise Exception('algorithm must be either the function dfs or the function bfs')
+    pattern_list = []
+    flat_list = []
+    consecutive_item_count = 0
+    async for chunk in _traverse(items,True,chunk_size or ASYNC_YIELD_INTERVAL):
+        for item in chunk:
+            if isinstance(item,NestDirective):
+                if consecutive_item_count > 0:
+                    pattern_list.append(str(consecutive_item_count))
+                    consecutive_item_count = 0
+                pattern_list.append(directive_token_map[item])
+            else:
+                consecutive_item_count += 1
+                flat_list.append(item)
+    if consecutive_item_count > 0:
+        pattern_list.append(str(consecutive_item_count))
+    return (''.join(pattern_list),flat_list)
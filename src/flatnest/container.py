@@ -0,0 +1,395 @@
+"""
+This module provides FlatNest, a mutable nested structure that keeps the index needed to convert between flat and nested indices up to date as values and nested lists are inserted and deleted.
+"""
+
+from bisect import bisect_right
+from itertools import accumulate
+from .flatnest import bfs, deflatten, dfs, flatten
+
+class _FenwickTree:
+    """
+    Binary indexed tree over a list of counts, giving prefix sums and point updates in logarithmic time
+
+    Appending and popping at the end are also logarithmic; inserting or deleting elsewhere requires a rebuild.
+    FlatNest keeps one over the chunks of each nested list (see _FlatNestNode), so rebuilds only happen when a chunk is split or emptied.
+    """
+    __slots__ = ('tree',)
+    def __init__(self,counts=()):
+        tree = [0]
+        tree.extend(counts)
+        size = len(tree)
+        for i in range(1,size):
+            parent = i + (i & -i)
+            if parent < size:
+                tree[parent] += tree[i]
+        self.tree = tree
+    def __len__(self):
+        return len(self.tree)-1
+    def add(self,index,delta):
+        tree = self.tree
+        index += 1
+        while index < len(tree):
+            tree[index] += delta
+            index += index & -index
+    def prefix(self,index):
+        """
+        Returns the sum of the first index counts
+        """
+        tree = self.tree
+        total = 0
+        while index > 0:
+            total += tree[index]
+            index -= index & -index
+        return total
+    def append(self,count):
+        index = len(self.tree)
+        self.tree.append(count + self.prefix(index-1) - self.prefix(index - (index & -index)))
+    def pop(self):
+        self.tree.pop()
+    def search(self,offset):
+        """
+        Returns (index, remainder) where index is the first position whose prefix sum including it exceeds offset
+        """
+        tree = self.tree
+        index = 0
+        step = 1
+        while step*2 < len(tree):
+            step *= 2
+        while step > 0:
+            if index + step < len(tree) and tree[index+step] <= offset:
+                index += step
+                offset -= tree[index]
+            step //= 2
+        return (index,offset)
+
+#number of items per chunk of a nested list in a FlatNest; a chunk is split in two when it reaches twice this size
+CHUNK_SIZE = 512
+
+class _FlatNestNode:
+    """
+    A nested list of a FlatNest
+
+    The items are kept in chunks of up to 2*CHUNK_SIZE items, next to the number of values under each item, with Fenwick trees over the chunk lengths and the chunk totals.
+    Finding an item by position or by number of values before it, and inserting, deleting or recounting an item, take a logarithmic search over the chunks and list operations within one chunk.
+    """
+    __slots__ = ('chunks','counts','lengths','totals','length','size')
+    def __init__(self,items=(),counts=()):
+        self.chunks = [items[start:start+CHUNK_SIZE] for start in range(0,len(items),CHUNK_SIZE)]
+        self.counts = [counts[start:start+CHUNK_SIZE] for start in range(0,len(counts),CHUNK_SIZE)]
+        self.length = len(items)
+        self.size = sum(counts)
+        self._index_chunks()
+    def _index_chunks(self):
+        self.lengths = _FenwickTree([len(chunk) for chunk in self.chunks])
+        self.totals = _FenwickTree([sum(counts) for counts in self.counts])
+    def __len__(self):
+        return self.length
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+    def _locate(self,index):
+        """
+        Returns (chunk, position in the chunk) of the item at index
+        """
+        return self.lengths.search(index)
+    def __getitem__(self,index):
+        chunk,position = self._locate(index)
+        return self.chunks[chunk][position]
+    def prefix(self,index):
+        """
+        Returns the number of values under the first index items
+        """
+        if index == self.length:
+            return self.size
+        chunk,position = self._locate(index)
+        return self.totals.prefix(chunk) + sum(self.counts[chunk][:position])
+    def search(self,offset):
+        """
+        Returns (index, remainder) where index is the item under which the value numbered offset is
+        """
+        chunk,offset = self.totals.search(offset)
+        cumulative = list(accumulate(self.counts[chunk]))
+        position = bisect_right(cumulative,offset)
+        if position > 0:
+            offset -= cumulative[position-1]
+        return (self.lengths.prefix(chunk)+position,offset)
+    def add(self,index,delta):
+        """
+        Changes the number of values under the item at index by delta
+        """
+        chunk,position = self._locate(index)
+        self.counts[chunk][position] += delta
+        self.totals.add(chunk,delta)
+        self.size += delta
+    def replace(self,index,item,count):
+        """
+        Replaces the item at index and returns the change in the number of values
+        """
+        chunk,position = self._locate(index)
+        delta = count - self.counts[chunk][position]
+        self.chunks[chunk][position] = item
+        self.counts[chunk][position] = count
+        self.totals.add(chunk,delta)
+        self.size += delta
+        return delta
+    def insert(self,index,item,count):
+        if len(self.chunks) == 0:
+            self.chunks.append([])
+            self.counts.append([])
+            self.lengths.append(0)
+            self.totals.append(0)
+        if index == self.length:
+            chunk = len(self.chunks)-1
+            position = len(self.chunks[chunk])
+        else:
+            chunk,position = self._locate(index)
+        self.chunks[chunk].insert(position,item)
+        self.counts[chunk].insert(position,count)
+        self.lengths.add(chunk,1)
+        self.totals.add(chunk,count)
+        self.length += 1
+        self.size += count
+        if len(self.chunks[chunk]) >= 2*CHUNK_SIZE:
+            self.chunks[chunk:chunk+1] = [self.chunks[chunk][:CHUNK_SIZE],self.chunks[chunk][CHUNK_SIZE:]]
+            self.counts[chunk:chunk+1] = [self.counts[chunk][:CHUNK_SIZE],self.counts[chunk][CHUNK_SIZE:]]
+            self._index_chunks()
+    def pop(self,index):
+        """
+        Removes the item at index and returns (item, number of values under it)
+        """
+        chunk,position = self._locate(index)
+        item = self.chunks[chunk].pop(position)
+        count = self.counts[chunk].pop(position)
+        self.lengths.add(chunk,-1)
+        self.totals.add(chunk,-count)
+        self.length -= 1
+        self.size -= count
+        if len(self.chunks[chunk]) == 0:
+            del self.chunks[chunk]
+            del self.counts[chunk]
+            if chunk == len(self.chunks):
+                self.lengths.pop()
+                self.totals.pop()
+            else:
+                self._index_chunks()
+        return (item,count)
+
+def _count(item):
+    return item.size if isinstance(item,_FlatNestNode) else 1
+
+def _build_node(items):
+    """
+    Copies nested lists/tuples into _FlatNestNode objects
+    """
+    lists = [list(items)]
+    for items in lists:
+        for i,item in enumerate(items):
+            if isinstance(item,(list,tuple)):
+                items[i] = list(item)
+                lists.append(items[i])
+    #children come after their parents, so build the nodes in reverse
+    nodes = {}
+    for items in reversed(lists):
+        for i,item in enumerate(items):
+            if isinstance(item,list):
+                items[i] = nodes.pop(id(item))
+        nodes[id(items)] = _FlatNestNode(items,[_count(item) for item in items])
+    return nodes[id(lists[0])]
+
+class FlatNest:
+    """
+    A mutable nested list structure indexed for flat index conversion
+
+    Values and nested lists can be inserted, appended and deleted at any nested position.
+    Every nested list keeps its items in chunks indexed by Fenwick trees of the chunk lengths and of the number of values under each chunk,
+    so an edit anywhere in a list updates one chunk of the edited list and one count per ancestor,
+    and conversions between dfs flat indices and nested indices take a logarithmic search per nesting level.
+
+    The structure pattern and flat list in either order are available through flatten, so it stays interchangeable with the module functions.
+
+    >>> f = FlatNest([1,[2,3],4])
+    >>> f.append([1],[5,6])
+    >>> f.insert([0],0)
+    >>> f.flatten()
+    ('2[2[2]]1', [0, 1, 2, 3, 5, 6, 4])
+    >>> f.get_nested_indices(5)
+    [2, 2, 1]
+    >>> f.get_flat_index([3])
+    6
+    >>> f.delete([2,0])
+    >>> f.flatten(bfs)
+    ('2*1|1*|2', [0, 1, 4, 3, 5, 6])
+    >>> f.tolist()
+    [0, 1, [3, [5, 6]], 4]
+
+    """
+    def __init__(self,nested_structure=()):
+        self._top = _build_node(nested_structure)
+
+    @classmethod
+    def from_flattened(cls,structure_pattern,flat_list):
+        """
+        Builds a FlatNest from a structure pattern (dfs or bfs) and its flat list
+        """
+        return cls(deflatten(structure_pattern,flat_list))
+
+    @property
+    def size(self):
+        """
+        The number of values in the structure
+        """
+        return self._top.size
+
+    def __len__(self):
+        return len(self._top)
+
+    def _walk(self,nest_indices):
+        """
+        Returns the list of (node, index) pairs along a sequence of nested indices, resolving negative indices
+        """
+        path = []
+        node = self._top
+        for index in nest_indices:
+            if not isinstance(node,_FlatNestNode):
+                raise Exception('The provided nest indices do not exist in the structure')
+            if index < 0:
+                index += len(node)
+            if not 0 <= index < len(node):
+                raise Exception('The provided nest indices do not exist in the structure')
+            path.append((node,index))
+            node = node[index]
+        return path
+
+    def _get_list(self,nest_indices):
+        """
+        Returns (path, node) for the nested list at the sequence of nested indices
+        """
+        path = self._walk(nest_indices)
+        node = path[-1][0][path[-1][1]] if len(path) > 0 else self._top
+        if not isinstance(node,_FlatNestNode):
+            raise Exception('The provided nest indices do not refer to a nested list')
+        return (path,node)
+
+    def _propagate(self,path,delta):
+        for node,index in path:
+            node.add(index,delta)
+
+    def get(self,nest_indices):
+        """
+        Returns the value, or the nested list (as plain lists), at the sequence of nested indices
+        """
+        path = self._walk(nest_indices)
+        if len(path) == 0:
+            return self.tolist()
+        item = path[-1][0][path[-1][1]]
+        return _tolist(item) if isinstance(item,_FlatNestNode) else item
+
+    def set(self,nest_indices,item):
+        """
+        Replaces the value or nested list at the sequence of nested indices
+        """
+        path = self._walk(nest_indices)
+        if len(path) == 0:
+            raise Exception('The top level of the structure cannot be replaced')
+        node,index = path.pop()
+        if isinstance(item,(list,tuple)):
+            item = _build_node(item)
+        self._propagate(path,node.replace(index,item,_count(item)))
+
+    def insert(self,nest_indices,item):
+        """
+        Inserts a value, or a nested list given as a list or tuple, so that it ends up at the sequence of nested indices
+
+        The last index may equal the length of the nested list to insert at its end
+        """
+        path,node = self._get_list(nest_indices[:-1])
+        index = nest_indices[-1]
+        if index < 0:
+            index += len(node)
+        if not 0 <= index <= len(node):
+            raise Exception('The provided nest indices do not exist in the structure')
+        if isinstance(item,(list,tuple)):
+            item = _build_node(item)
+        count = _count(item)
+        node.insert(index,item,count)
+        self._propagate(path,count)
+
+    def append(self,nest_indices,item):
+        """
+        Appends a value, or a nested list given as a list or tuple, to the nested list at the sequence of nested indices
+        """
+        node = self._get_list(nest_indices)[1]
+        self.insert(list(nest_indices)+[len(node)],item)
+
+    def delete(self,nest_indices):
+        """
+        Deletes the value or nested list at the sequence of nested indices
+        """
+        path = self._walk(nest_indices)
+        if len(path) == 0:
+            raise Exception('The top level of the structure cannot be deleted')
+        node,index = path.pop()
+        count = node.pop(index)[1]
+        self._propagate(path,-count)
+
+    def __getitem__(self,nest_indices):
+        return self.get(nest_indices if isinstance(nest_indices,(tuple,list)) else (nest_indices,))
+    def __setitem__(self,nest_indices,item):
+        self.set(nest_indices if isinstance(nest_indices,(tuple,list)) else (nest_indices,),item)
+    def __delitem__(self,nest_indices):
+        self.delete(nest_indices if isinstance(nest_indices,(tuple,list)) else (nest_indices,))
+
+    def get_flat_index(self,nest_indices):
+        """
+        Returns the dfs flat index of the value at the sequence of nested indices
+        """
+        path = self._walk(nest_indices)
+        if len(path) == 0 or isinstance(path[-1][0][path[-1][1]],_FlatNestNode):
+            raise Exception('The provided nest indices do not exist in the structure')
+        return sum(node.prefix(index) for node,index in path)
+
+    def get_nested_indices(self,flat_index):
+        """
+        Returns the sequence of nested indices of the value at a dfs flat index (negative indices work from the end)
+        """
+        if flat_index < 0:
+            flat_index += self.size
+        if not 0 <= flat_index < self.size:
+            raise Exception('flat index exceeds size implied by structure')
+        nest_indices = []
+        node = self._top
+        while isinstance(node,_FlatNestNode):
+            index,flat_index = node.search(flat_index)
+            nest_indices.append(index)
+            node = node[index]
+        return nest_indices
+
+    def flatten(self,algorithm=dfs):
+        """
+        Returns (structure pattern, flat list) as the flatten function does
+        """
+        return flatten(self.tolist(),algorithm)
+
+    def tolist(self):
+        """
+        Returns the structure as plain nested lists
+        """
+        return _tolist(self._top)
+
+    def __repr__(self):
+        return 'FlatNest('+repr(self.tolist())+')'
+
+def _tolist(node):
+    top = []
+    stack = [(top,iter(node))]
+    while len(stack) > 0:
+        target,items = stack[-1]
+        for item in items:
+            if isinstance(item,_FlatNestNode):
+                target.append([])
+                stack.append((target[-1],iter(item)))
+                break
+            target.append(item)
+        else:
+            stack.pop()
+    return top
@@ -0,0 +1,218 @@
+"""
+This module stores a (structure pattern, flat list) pair in a single file that can be memory-mapped and read without loading it.
+
+The file holds, in order:
+
+- a fixed size header
+- the structure pattern in its binary encoding (see encode_pattern)
+- the nested index of the pattern as int64 arrays (see StructurePattern._entry_tables)
+- the flat list as an array of fixed width values (any array.array typecode)
+
+A value or a subtree is read by nested index with one binary search per nesting level over the stored index, touching only the pages it needs.
+"""
+
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from .flatnest import compile_pattern, deflatten, dfs, encode_pattern, flatten
+
+FLATFILE_MAGIC = b'FLATNEST'
+FLATFILE_VERSION = 1
+#magic, version, byteorder (0 little, 1 big), typecode, pattern length, node count, entry count, value count
+_header_struct = struct.Struct('<8sBBcxQQQQ')
+_table_names = ('node_base','node_length','entry_keys','entry_child','entry_flat')
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+def save_flattened(path,structure_pattern,flat_list,typecode='d'):
+    """
+    Writes a structure pattern (dfs or bfs) and its flat list to a file readable with FlatNestFile
+
+    typecode is the array.array typecode the values are stored as
+    """
+    structure_pattern = compile_pattern(structure_pattern)
+    if len(flat_list) < structure_pattern.size:
+        raise Exception('structure_pattern implies more values than flat_list contains')
+    if len(flat_list) > structure_pattern.size:
+        raise Exception('flat_list has more data than structure_pattern implies')
+    encoded = encode_pattern(structure_pattern)
+    tables = structure_pattern._entry_tables()
+    values = flat_list if isinstance(flat_list,array) and flat_list.typecode == typecode else array(typecode,flat_list)
+    with open(path,'wb') as f:
+        f.write(_header_struct.pack(FLATFILE_MAGIC,FLATFILE_VERSION,(0 if sys.byteorder == 'little' else 1),typecode.encode('ascii'),len(encoded),len(tables['node_base']),len(tables['entry_keys']),len(values)))
+        f.write(encoded)
+        f.write(b'\0'*(_align(f.tell())-f.tell()))
+        for name in _table_names:
+            tables[name].tofile(f)
+        f.write(b'\0'*(_align(f.tell())-f.tell()))
+        values.tofile(f)
+
+def save_nested(path,nested_structure,typecode='d',algorithm=dfs):
+    """
+    Flattens the nested structure and writes it to a file readable with FlatNestFile
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(),'data.flatnest')
+    >>> save_nested(path,[1,[2,3,[4,5,[6,7],8,9],10,11],12],'q')
+    >>> with FlatNestFile(path) as f:
+    ...     (f[1,2,0], f[1,2,2], len(f), f.pattern)
+    (4, [6, 7], 12, StructurePattern('1[2[2[2]2]2]1'))
+
+    """
+    structure_pattern,flat_list = flatten(nested_structure,algorithm)
+    save_flattened(path,structure_pattern,flat_list,typecode)
+
+class FlatNestFile:
+    """
+    Reads a file written by save_flattened or save_nested through mmap
+
+    Indexing with a sequence of nested indices returns the value at that position, or the nested list of the subtree there.
+    values is a zero-copy memoryview of the flat list in the file.
+    """
+    def __init__(self,path):
+        self._file = open(path,'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        self._buffer = memoryview(self._mmap)
+        magic,version,byteorder,typecode,pattern_length,node_count,entry_count,size = _header_struct.unpack_from(self._buffer)
+        if magic != FLATFILE_MAGIC or version != FLATFILE_VERSION:
+            self.close()
+            raise Exception('Not a flatnest file')
+        if byteorder != (0 if sys.byteorder == 'little' else 1):
+            self.close()
+            raise Exception('flatnest file was written on a machine with a different byte order')
+        self.typecode = typecode.decode('ascii')
+        self.size = size
+        offset = _header_struct.size
+        self._encoded_pattern = self._buffer[offset:offset+pattern_length]
+        offset = _align(offset+pattern_length)
+        self._tables = {}
+        for name in _table_names:
+            count = node_count if name.startswith('node') else entry_count
+            self._tables[name] = self._buffer[offset:offset+8*count].cast('q')
+            offset += 8*count
+        offset = _align(offset)
+        itemsize = array(self.typecode).itemsize
+        self.values = self._buffer[offset:offset+itemsize*size].cast(self.typecode)
+        self._pattern = None
+
+    @property
+    def pattern(self):
+        """
+        The StructurePattern of the stored structure, parsed on first use
+        """
+        if self._pattern is None:
+            self._pattern = compile_pattern(bytes(self._encoded_pattern))
+        return self._pattern
+
+    def __len__(self):
+        return self.size
+
+    def _entries(self,node):
+        """
+        Returns the range of entry positions of a nested list number
+        """
+        keys = self._tables['entry_keys']
+        base = self._tables['node_base'][node]
+        return range(bisect_left(keys,base),bisect_left(keys,base+self._tables['node_length'][node]))
+
+    def _locate(self,nest_indices):
+        """
+        Returns ('value', flat index) or ('node', nested list number) for a sequence of nested indices
+        """
+        tables = self._tables
+        node = 0
+        for index in nest_indices:
+            if node < 0 or not 0 <= index < tables['node_length'][node]:
+                raise Exception('The provided nest indices do not exist in the structure pattern')
+            key = tables['node_base'][node]+index
+            position = bisect_right(tables['entry_keys'],key)-1
+            node = tables['entry_child'][position]
+            if node < 0:
+                flat_index = tables['entry_flat'][position]+index
+        if node < 0:
+            return ('value',flat_index)
+        return ('node',node)
+
+    def get_flat_index(self,nest_indices):
+        """
+        Same as the get_flat_index function, using the index stored in the file
+        """
+        kind,position = self._locate(nest_indices)
+        if kind != 'value' or len(nest_indices) == 0:
+            raise Exception('The provided nest indices do not exist in the structure pattern')
+        return position
+
+    def __getitem__(self,nest_indices):
+        if not isinstance(nest_indices,(tuple,list)):
+            nest_indices = (nest_indices,)
+        kind,position = self._locate(nest_indices)
+        if kind == 'value':
+            return self.values[position]
+        return self._read_node(position)
+
+    def _read_node(self,node):
+        """
+        Builds the nested list of a nested list number from the stored index and values
+        """
+        tables = self._tables
+        keys = tables['entry_keys']
+        top = []
+        stack = [(top,node,iter(self._entries(node)))]
+        while len(stack) > 0:
+            target,node,positions = stack[-1]
+            for position in positions:
+                child = tables['entry_child'][position]
+                if child >= 0:
+                    nested_structure = []
+                    target.append(nested_structure)
+                    stack.append((nested_structure,child,iter(self._entries(child))))
+                    break
+                start = keys[position]-tables['node_base'][node]
+                if position+1 < len(keys) and keys[position+1] < tables['node_base'][node]+tables['node_length'][node]:
+                    stop = keys[position+1]-tables['node_base'][node]
+                else:
+                    stop = tables['node_length'][node]
+                flat_start = tables['entry_flat'][position]+start
+                target.extend(self.values[flat_start:flat_start+stop-start].tolist())
+            else:
+                stack.pop()
+        return top
+
+    def deflatten(self):
+        """
+        Reads the whole nested structure (as deflatten does)
+        """
+        return deflatten(self.pattern,self.values.tolist())
+
+    def close(self):
+        """
+        Releases the memory map and closes the file
+
+        Views of values still held elsewhere stay valid; the memory map is then unmapped when the last of them is released.
+        """
+        if self._mmap is None:
+            return
+        mapped = self._mmap
+        self._mmap = None
+        self.values = None
+        self._tables = None
+        self._encoded_pattern = None
+        self._buffer.release()
+        self._file.close()
+        try:
+            mapped.close()
+        except BufferError:
+            #exported views keep a reference to the map, which unmaps itself when they are gone
+            pass
+
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc_info):
+        self.close()
@@ -6,26 +6,39 @@ A number represents the number of consecutive values at the current level of the
 An opening square bracket represents entering a deeper level of nesting.
 A closing square bracket represents leaving a deper level of nesting.
 The square brackets at the top level (would be first and last characters of every pattern) are omitted.
+A number followed by an x repeats the nested list that follows it, so '3x[2]' is the same pattern as '[2][2][2]' (see compress_pattern and expand_pattern).
 """
 
+import json
 import re
-from collections import deque
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque, namedtuple
 from enum import Enum
+from itertools import islice, repeat
+try:
+    import numpy as _numpy
+except ImportError:
+    _numpy = None
 class NestDirective(Enum):
     DFS_PUSH=1
     DFS_POP=2
     BFS_QUEUE=3
     BFS_SERVE=4
+    REPEAT=5
 directive_token_map = {
         NestDirective.DFS_PUSH: '[',
         NestDirective.DFS_POP: ']',
         NestDirective.BFS_QUEUE: '*',
         NestDirective.BFS_SERVE: '|',
+        NestDirective.REPEAT: 'x',
         }
 #invert the directive_token_map dict
 token_directive_map = {token:directive for directive,token in directive_token_map.items()}
 
-def dfs(nested_structure,include_nest_directives=False,yield_condition=None,get_children_func=None):
+def dfs(nested_structure,include_nest_directives=False,yield_condition=None,get_children_func=None,stats=None,containers=None):
     """
     Implements a depth-first-search traversal of a nested list structure
 
@@ -39,6 +52,10 @@ def dfs(nested_structure,include_nest_directives=False,yield_condition=None,get_
 
     If an item is to be yielded and has children, then it is yielded before its children are processed.
 
+    stats is a TraversalStats to fill, or a function called with a TraversalStats, once the traversal is done (see TraversalStats)
+
+    containers is a ContainerRegistry giving the defaults of yield_condition and get_children_func: items of a registered container type are traversed, all other items are yielded
+
     >>> list(dfs([1,[2,3,[4,5,[6,7],8,9],10,11],12]))
     [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
 
@@ -51,6 +68,17 @@ def dfs(nested_structure,include_nest_directives=False,yield_condition=None,get_
     >>> list(dfs([]))
     []
     """
+    if containers is not None:
+        nested_structure = containers.get_children(nested_structure)
+        if nested_structure is None:
+            raise Exception('nested_structure is not of a registered container type')
+        yield_condition,get_children_func = containers._traversal_functions(yield_condition,get_children_func)
+    if stats is not None:
+        yield from _traverse_with_stats(dfs,nested_structure,include_nest_directives,yield_condition,get_children_func,stats)
+        return
+    if yield_condition is None and get_children_func is None:
+        yield from _dfs_lists(nested_structure,include_nest_directives)
+        return
     if yield_condition is None:
         yield_condition = lambda item: not isinstance(item,(list,tuple))
     if get_children_func is None:
@@ -76,13 +104,13 @@ def dfs(nested_structure,include_nest_directives=False,yield_condition=None,get_
             if len(stack) > 1 and include_nest_directives:
                 yield NestDirective.DFS_POP
             stack.pop()
-def bfs(nested_structure,include_nest_directives=False,yield_condition=None,get_children_func=None):
+def bfs(nested_structure,include_nest_directives=False,yield_condition=None,get_children_func=None,stats=None,containers=None):
     """
     Implements a breadth-first-search traversal of a nested list structure
     
     include_nest_directives will yield instances of NestDirective.BFS_QUEUE and NestDirective.BFS_SERVE when encountering a subtree and when switching to process a new subtree
 
-    yield_condition and get_children_func have the same meaning as in the dfs function
+    yield_condition, get_children_func, stats and containers have the same meaning as in the dfs function
     
     >>> list(bfs([1,[2,3,[4,5,[6,7],8,9],10,11],12]))
     [1, 12, 2, 3, 10, 11, 4, 5, 8, 9, 6, 7]
@@ -96,6 +124,17 @@ def bfs(nested_structure,include_nest_directives=False,yield_condition=None,get_
     >>> list(bfs([]))
     []
     """
+    if containers is not None:
+        nested_structure = containers.get_children(nested_structure)
+        if nested_structure is None:
+            raise Exception('nested_structure is not of a registered container type')
+        yield_condition,get_children_func = containers._traversal_functions(yield_condition,get_children_func)
+    if stats is not None:
+        yield from _traverse_with_stats(bfs,nested_structure,include_nest_directives,yield_condition,get_children_func,stats)
+        return
+    if yield_condition is None and get_children_func is None:
+        yield from _bfs_lists(nested_structure,include_nest_directives)
+        return
     if yield_condition is None:
         yield_condition = lambda item: not isinstance(item,(list,tuple))
     if get_children_func is None:
@@ -108,14 +147,298 @@ def bfs(nested_structure,include_nest_directives=False,yield_condition=None,get_
                 yield item
             children = get_children_func(item)
             if children is not None:
+                if include_nest_directives:
+                    yield NestDirective.BFS_QUEUE
+                queue.append(children)
+        if len(queue) > 0 and include_nest_directives:
+            yield NestDirective.BFS_SERVE
+
+#the default yield_condition and get_children_func, inlined
+def _dfs_lists(nested_structure,include_nest_directives):
+    stack = [iter(nested_structure)]
+    while len(stack) > 0:
+        for item in stack[-1]:
+            if isinstance(item,(list,tuple)):
+                if include_nest_directives:
+                    yield NestDirective.DFS_PUSH
+                stack.append(iter(item))
+                break
+            yield item
+        else:
+            stack.pop()
+            if len(stack) > 0 and include_nest_directives:
+                yield NestDirective.DFS_POP
+def _bfs_lists(nested_structure,include_nest_directives):
+    queue = deque([nested_structure])
+    while len(queue) > 0:
+        for item in queue.popleft():
+            if isinstance(item,(list,tuple)):
                 if include_nest_directives:
                     yield NestDirective.BFS_QUEUE
                 queue.append(item)
+            else:
+                yield item
         if len(queue) > 0 and include_nest_directives:
             yield NestDirective.BFS_SERVE
 
+def _sequence_children(item):
+    return (item,None)
+def _sequence_rebuild(container_type,children,info):
+    return children if container_type is list else container_type(children)
+def _dict_children(item):
+    return (list(item.values()),tuple(item.keys()))
+def _dict_rebuild(container_type,children,info):
+    return container_type(zip(info,children))
+def _is_namedtuple_type(item_type):
+    return issubclass(item_type,tuple) and hasattr(item_type,'_fields')
+def _namedtuple_children(item):
+    return (list(item),None)
+def _namedtuple_rebuild(container_type,children,info):
+    return container_type(*children)
+def _dataclass_children(item):
+    #only registered when dataclasses imports, see ContainerRegistry
+    import dataclasses
+    names = tuple([field.name for field in dataclasses.fields(item) if field.init])
+    return ([getattr(item,name) for name in names],names)
+def _dataclass_rebuild(container_type,children,info):
+    return container_type(**dict(zip(info,children)))
+def _ndarray_children(item):
+    #subarrays are containers in turn, the last axis holds the values
+    return ((list(item) if item.ndim > 1 else item.reshape(-1).tolist()),(item.dtype,item.shape))
+def _ndarray_rebuild(container_type,children,info):
+    return _numpy.array(children,dtype=info[0]).reshape(info[1])
 
-def flatten(nested_structure,algorithm=dfs):
+class ContainerRegistry:
+    """
+    Maps container types to the functions extracting their children, for the containers argument of dfs, bfs, flatten and deflatten
+
+    A new registry knows lists and tuples, like the default traversal.
+    With standard=True it also knows dicts (the values are the children and the keys are kept as container information), namedtuples, dataclasses (Python 3.7 or later) and numpy arrays (when numpy is installed).
+
+    For every container, flatten records its type and information in a list (one entry per nested list, in the order of the algorithm, None for plain lists) that deflatten uses to rebuild the same types.
+    The structure pattern itself is unchanged, so it works with every other function.
+
+    The container (or value) kind of a type is resolved once and cached: an explicitly registered type first, then registered families (e.g. namedtuples), then the nearest registered base class.
+
+    >>> from collections import namedtuple
+    >>> Point = namedtuple('Point','x y')
+    >>> pattern, flat_list, container_info = flatten({'a':[1,2],'b':Point(3,4)},containers=standard_containers)
+    >>> pattern, flat_list
+    ('[2][2]', [1, 2, 3, 4])
+    >>> deflatten(pattern,flat_list,container_info=container_info)
+    {'a': [1, 2], 'b': Point(x=3, y=4)}
+    >>> list(dfs({'a':[1,2],'b':3},containers=standard_containers))
+    [1, 2, 3]
+
+    """
+    def __init__(self,standard=False):
+        self._types = {}
+        self._families = []
+        self._cache = {}
+        self.register(list)
+        self.register(tuple)
+        if standard:
+            self.register(dict,_dict_children,_dict_rebuild)
+            self.register_family(_is_namedtuple_type,_namedtuple_children,_namedtuple_rebuild)
+            try:
+                import dataclasses
+            except ImportError:
+                dataclasses = None
+            if dataclasses is not None:
+                self.register_family(dataclasses.is_dataclass,_dataclass_children,_dataclass_rebuild)
+            if _numpy is not None:
+                self.register(_numpy.ndarray,_ndarray_children,_ndarray_rebuild)
+
+    def register(self,container_type,get_children=None,rebuild=None):
+        """
+        Registers container_type (and its subclasses not registered otherwise)
+
+        get_children(item) returns (children, info): the sequence of child items and any information other than the children needed to rebuild item, e.g. the keys of a dict
+        rebuild(container_type, children, info) returns the container from the list of its rebuilt children
+        The defaults treat the container as a sequence: the children are the item itself and it is rebuilt as container_type(children)
+        """
+        self._types[container_type] = (get_children or _sequence_children,rebuild or _sequence_rebuild)
+        self._cache.clear()
+
+    def register_family(self,predicate,get_children,rebuild):
+        """
+        Registers every type for which predicate(type) is true, with get_children and rebuild as for register
+        """
+        self._families.append((predicate,(get_children,rebuild)))
+        self._cache.clear()
+
+    def lookup(self,item_type):
+        """
+        Returns (get_children, rebuild) for a type, or None if items of that type are values
+        """
+        entry = self._cache.get(item_type,_unresolved)
+        if entry is not _unresolved:
+            return entry
+        entry = self._types.get(item_type)
+        if entry is None:
+            for predicate,family_entry in self._families:
+                if predicate(item_type):
+                    entry = family_entry
+                    break
+        if entry is None:
+            for base in item_type.__mro__[1:]:
+                if base in self._types:
+                    entry = self._types[base]
+                    break
+        self._cache[item_type] = entry
+        return entry
+
+    def get_children(self,item):
+        """
+        Returns the children of a container, or None if item is a value
+        """
+        entry = self.lookup(type(item))
+        return None if entry is None else entry[0](item)[0]
+
+    def _traversal_functions(self,yield_condition,get_children_func):
+        if yield_condition is None:
+            yield_condition = lambda item: self.lookup(type(item)) is None
+        if get_children_func is None:
+            get_children_func = self.get_children
+        return (yield_condition,get_children_func)
+
+    def _rebuild(self,top_nested_structure,created,container_info):
+        """
+        Replaces the nested lists built by deflatten with the containers recorded in container_info
+
+        created holds (nested list, parent list, index in parent) for each nested list below the top one, in creation order
+        """
+        nodes = [(top_nested_structure,None,None)] + created
+        if len(container_info) != len(nodes):
+            raise Exception('container_info does not match the nested lists of the structure pattern')
+        #children are created after their parents, so rebuild in reverse
+        for position in range(len(nodes)-1,-1,-1):
+            if container_info[position] is None:
+                continue
+            nested_structure,parent,index = nodes[position]
+            container_type,info = container_info[position]
+            entry = self.lookup(container_type)
+            if entry is None:
+                raise Exception('container_info has a type that is not registered: '+repr(container_type))
+            nested_structure = entry[1](container_type,nested_structure,info)
+            if parent is None:
+                top_nested_structure = nested_structure
+            else:
+                parent[index] = nested_structure
+        return top_nested_structure
+
+_unresolved = object()
+
+#the registry used by deflatten when given container_info without containers
+standard_containers = ContainerRegistry(standard=True)
+
+def _container_children(containers,item,container_info):
+    """
+    Returns the children of item if its type is registered in containers (recording its type in container_info), otherwise None
+    """
+    item_type = type(item)
+    entry = containers._cache.get(item_type,_unresolved)
+    if entry is _unresolved:
+        entry = containers.lookup(item_type)
+    if entry is None:
+        return None
+    children,info = entry[0](item)
+    container_info.append(None if item_type is list else (item_type,info))
+    return children
+
+class TraversalStats:
+    """
+    Figures about the shape of a nested structure
+
+    Filled by dfs, bfs, flatten and deflatten when given a stats argument, and returned by pattern_stats.
+
+    lists is the number of lists, including the top level list, and leaves the number of values.
+    max_depth is the deepest nesting level, the top level list being at depth 0.
+    level_lists[d] is the number of lists at depth d and level_items[d] the number of items (values and nested lists) directly in them, so level_items[d]/level_lists[d] is the mean fan-out at depth d.
+    largest_run is the largest number of consecutive values in a list (a number of the structure pattern).
+    times maps each phase of the call that produced the stats to its wall time in seconds.
+
+    >>> stats = TraversalStats()
+    >>> flatten([1,[2,3,[4,5,[6,7],8,9],10,11],12],stats=stats)[0]
+    '1[2[2[2]2]2]1'
+    >>> stats
+    TraversalStats(lists=4, leaves=12, max_depth=3, level_lists=[1, 1, 1, 1], level_items=[3, 5, 5, 2], largest_run=2)
+    >>> sorted(stats.times)
+    ['flatten']
+
+    """
+    def __init__(self):
+        self.lists = 1
+        self.leaves = 0
+        self.max_depth = 0
+        self.level_lists = [1]
+        self.level_items = [0]
+        self.largest_run = 0
+        self.times = {}
+    def _add_run(self,depth,count):
+        """
+        Counts a run of count values in a list at depth
+        """
+        self.leaves += count
+        self.level_items[depth] += count
+        if count > self.largest_run:
+            self.largest_run = count
+    def _add_list(self,depth):
+        """
+        Counts a nested list at depth (1 or more)
+        """
+        self.lists += 1
+        self.level_items[depth-1] += 1
+        if depth == len(self.level_lists):
+            self.level_lists.append(0)
+            self.level_items.append(0)
+            self.max_depth = depth
+        self.level_lists[depth] += 1
+    def __repr__(self):
+        return 'TraversalStats(lists=%d, leaves=%d, max_depth=%d, level_lists=%r, level_items=%r, largest_run=%d)' % (self.lists,self.leaves,self.max_depth,self.level_lists,self.level_items,self.largest_run)
+
+def _report_stats(stats,collected):
+    """
+    Hands the collected TraversalStats to the stats argument of a traversal (a TraversalStats to fill or a function)
+    """
+    if isinstance(stats,TraversalStats):
+        stats.__dict__.update(collected.__dict__)
+    else:
+        stats(collected)
+
+def _traverse_with_stats(algorithm,nested_structure,include_nest_directives,yield_condition,get_children_func,stats):
+    """
+    dfs or bfs, counting the figures of TraversalStats from the nest directives as items are yielded
+    """
+    collected = TraversalStats()
+    depth = 0
+    run = 0
+    queued_depths = deque()
+    start = time.perf_counter()
+    for item in algorithm(nested_structure,True,yield_condition,get_children_func):
+        if not isinstance(item,NestDirective):
+            run += 1
+            yield item
+            continue
+        collected._add_run(depth,run)
+        run = 0
+        if item is NestDirective.DFS_PUSH or item is NestDirective.BFS_QUEUE:
+            collected._add_list(depth+1)
+            if item is NestDirective.DFS_PUSH:
+                depth += 1
+            else:
+                queued_depths.append(depth+1)
+        elif item is NestDirective.DFS_POP:
+            depth -= 1
+        else:
+            depth = queued_depths.popleft()
+        if include_nest_directives:
+            yield item
+    collected._add_run(depth,run)
+    collected.times['traverse'] = time.perf_counter()-start
+    _report_stats(stats,collected)
+
+def flatten(nested_structure,algorithm=dfs,compress=False,stats=None,containers=None):
     """
     Traverses the nested structure according to the algorithm.
     Produces a structure pattern string and a flat list
@@ -130,33 +453,1526 @@ def flatten(nested_structure,algorithm=dfs):
     >>> flatten([1,[2,3,[4,5,[6,7],8,9],10,11],12],bfs)
     ('1*1|2*2|2*2|2', [1, 12, 2, 3, 10, 11, 4, 5, 8, 9, 6, 7])
 
+    With compress=True, consecutive nested lists of the same shape are written with the repeat syntax (see compress_pattern)
+
+    >>> flatten([[1,2],[3,4],[5,6]],compress=True)
+    ('3x[2]', [1, 2, 3, 4, 5, 6])
+
+    stats is a TraversalStats to fill, or a function called with a TraversalStats, counted during the traversal
+
+    With a ContainerRegistry as containers, the items of every registered type are traversed as nested lists,
+    and (structure pattern, flat list, container info) is returned, container info recording the type of each nested list for deflatten (see ContainerRegistry)
+
     """
+    start = time.perf_counter()
     if algorithm not in [dfs,bfs]:
         raise Exception('algorithm must be either the function dfs or the function bfs')
     pattern_list = []
     flat_list = []
+    collected = None if stats is None else TraversalStats()
+    container_info = None
+    if containers is not None:
+        container_info = []
+        nested_structure = _container_children(containers,nested_structure,container_info)
+        if nested_structure is None:
+            raise Exception('nested_structure is not of a registered container type')
+    flatten_lists = _flatten_dfs_lists if algorithm is dfs else _flatten_bfs_lists
+    flatten_lists(nested_structure,pattern_list.append,flat_list.append,containers,container_info,collected)
+    structure_pattern = ''.join(pattern_list)
+    if compress:
+        structure_pattern = compress_pattern(structure_pattern)
+    if stats is not None:
+        collected.times['flatten'] = time.perf_counter()-start
+        _report_stats(stats,collected)
+    if containers is not None:
+        return (structure_pattern,flat_list,container_info)
+    return (structure_pattern,flat_list)
+
+def _join_top_level_patterns(patterns):
+    """
+    Concatenates the top levels of dfs patterns (or of the first groups of bfs patterns), adding up the numbers that meet at each boundary
+    """
+    parts = []
+    for pattern in patterns:
+        if pattern == '':
+            continue
+        if len(parts) > 0 and parts[-1][-1].isdigit() and pattern[0].isdigit():
+            tail = len(parts[-1])
+            while tail > 0 and parts[-1][tail-1].isdigit():
+                tail -= 1
+            head = 0
+            while head < len(pattern) and pattern[head].isdigit():
+                head += 1
+            parts[-1] = parts[-1][:tail] + str(int(parts[-1][tail:])+int(pattern[:head]))
+            pattern = pattern[head:]
+            if pattern == '':
+                continue
+        parts.append(pattern)
+    return ''.join(parts)
+
+def _split_bfs_levels(bfs_pattern):
+    """
+    Splits a bfs pattern into a list of levels, each level being the list of groups (one per nested list) at that depth
+    """
+    groups = bfs_pattern.split(directive_token_map[NestDirective.BFS_SERVE])
+    queue_token = directive_token_map[NestDirective.BFS_QUEUE]
+    levels = []
+    position = 0
+    level_size = 1
+    while position < len(groups):
+        if level_size == 0:
+            raise Exception('Structure pattern contains imbalanced directive tokens')
+        level = groups[position:position+level_size]
+        levels.append(level)
+        position += level_size
+        level_size = sum([group.count(queue_token) for group in level])
+    return levels
+
+def _interleave_levels(levels_list,start=0):
+    """
+    Returns, for each depth from start on, the concatenation of the items at that depth of every list in levels_list
+    """
+    interleaved = []
+    depth = start
+    while True:
+        level = []
+        found = False
+        for pattern_levels in levels_list:
+            if depth < len(pattern_levels):
+                found = True
+                level.extend(pattern_levels[depth])
+        if not found:
+            return interleaved
+        interleaved.append(level)
+        depth += 1
+
+def _join_bfs_levels(levels_list):
+    """
+    Concatenates the top levels of bfs patterns given as lists of levels (see _split_bfs_levels), interleaving the deeper levels
+
+    Returns the list of levels of the result
+    """
+    return [[_join_top_level_patterns([pattern_levels[0][0] for pattern_levels in levels_list])]] + _interleave_levels(levels_list,1)
+
+def _split_bfs_flattened(bfs_pattern,flat_list):
+    """
+    Splits a bfs pattern and its flat list by level: returns (levels of groups, list of the values of each level)
+    """
+    if directive_token_map[NestDirective.REPEAT] in bfs_pattern:
+        bfs_pattern = expand_pattern(bfs_pattern)
+    levels = _split_bfs_levels(bfs_pattern)
+    level_values = []
+    position = 0
+    for level in levels:
+        count = sum([directive for group in level for directive in parse_pattern(group) if isinstance(directive,int)])
+        if position + count > len(flat_list):
+            raise Exception('structure_pattern implies more values than flat_list contains')
+        level_values.append(flat_list[position:position+count])
+        position += count
+    if position < len(flat_list):
+        raise Exception('flat_list has more data than structure_pattern implies')
+    return (levels,level_values)
+
+def _as_sink(sink,encoder=None):
+    """
+    Returns the function to call with each item emitted to sink (a callable or an object with a write or append method)
+
+    When encoder is given, an object with a write method is written encoder(item) instead of the item
+    """
+    if hasattr(sink,'write'):
+        if encoder is None:
+            return sink.write
+        write = sink.write
+        return lambda item: write(encoder(item))
+    if hasattr(sink,'append'):
+        return sink.append
+    if callable(sink):
+        return sink
+    raise Exception('sink must be callable or have a write or append method')
+
+def _json_line(value):
+    return json.dumps(value)+'\n'
+
+def flatten_stream(nested_structure,pattern_sink,value_sink,algorithm=dfs,value_encoder=_json_line):
+    """
+    Streaming form of flatten that emits the structure pattern and the flat values incrementally instead of returning them
+
+    pattern_sink receives the pattern as a sequence of string tokens (numbers and directive tokens), so a text file object can be given directly.
+    value_sink receives each value in flat order, as is, unless it is a file object (anything with a write method), which is written value_encoder(value) for each value.
+    The default value_encoder writes one JSON value per line, read back with json.loads on each line; pass one returning bytes for a binary file.
+    A sink is either a callable or an object with a write or append method.
+
+    Returns the number of values emitted
+
+    >>> import io
+    >>> pattern_file = io.StringIO()
+    >>> values = []
+    >>> flatten_stream([1,[2,3,[4,5,[6,7],8,9],10,11],12],pattern_file,values)
+    12
+    >>> pattern_file.getvalue()
+    '1[2[2[2]2]2]1'
+    >>> values
+    [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
+    >>> value_file = io.StringIO()
+    >>> flatten_stream([1,['a',2.5]],io.StringIO(),value_file)
+    3
+    >>> value_file.getvalue()
+    '1\\n"a"\\n2.5\\n'
+
+    """
+    if algorithm not in [dfs,bfs]:
+        raise Exception('algorithm must be either the function dfs or the function bfs')
+    emit_token = _as_sink(pattern_sink)
+    emit_value = _as_sink(value_sink,value_encoder)
+    if algorithm is dfs:
+        return _flatten_dfs_lists(nested_structure,emit_token,emit_value)
+    return _flatten_bfs_lists(nested_structure,emit_token,emit_value)
+
+#the traversals of flatten_stream, emitting tokens and values directly instead of going through the dfs/bfs generators
+#with a ContainerRegistry as containers, the items of registered types are traversed as nested lists and their types recorded in container_info
+#with a TraversalStats as stats, the lists and runs are counted as they are emitted
+def _flatten_dfs_lists(nested_structure,emit_token,emit_value,containers=None,container_info=None,stats=None):
+    push = directive_token_map[NestDirective.DFS_PUSH]
+    pop = directive_token_map[NestDirective.DFS_POP]
+    item_count = 0
     consecutive_item_count = 0
-    for item in algorithm(nested_structure,include_nest_directives=True):
-        if isinstance(item,NestDirective):
+    stack = [iter(nested_structure)]
+    while len(stack) > 0:
+        for item in stack[-1]:
+            if containers is None:
+                children = item if isinstance(item,(list,tuple)) else None
+            else:
+                children = _container_children(containers,item,container_info)
+            if children is not None:
+                if consecutive_item_count > 0:
+                    emit_token(str(consecutive_item_count))
+                    item_count += consecutive_item_count
+                    if stats is not None:
+                        stats._add_run(len(stack)-1,consecutive_item_count)
+                    consecutive_item_count = 0
+                emit_token(push)
+                if stats is not None:
+                    stats._add_list(len(stack))
+                stack.append(iter(children))
+                break
+            consecutive_item_count += 1
+            emit_value(item)
+        else:
+            stack.pop()
             if consecutive_item_count > 0:
-                pattern_list.append(str(consecutive_item_count))
+                emit_token(str(consecutive_item_count))
+                item_count += consecutive_item_count
+                if stats is not None:
+                    stats._add_run(len(stack),consecutive_item_count)
+                consecutive_item_count = 0
+            if len(stack) > 0:
+                emit_token(pop)
+    return item_count
+def _flatten_bfs_lists(nested_structure,emit_token,emit_value,containers=None,container_info=None,stats=None):
+    queue_token = directive_token_map[NestDirective.BFS_QUEUE]
+    serve = directive_token_map[NestDirective.BFS_SERVE]
+    item_count = 0
+    consecutive_item_count = 0
+    queue = deque([nested_structure])
+    #depth of each queued list, only kept for stats
+    depths = deque([0])
+    depth = 0
+    while len(queue) > 0:
+        if stats is not None:
+            depth = depths.popleft()
+        for item in queue.popleft():
+            if containers is None:
+                children = item if isinstance(item,(list,tuple)) else None
+            else:
+                children = _container_children(containers,item,container_info)
+            if children is not None:
+                if consecutive_item_count > 0:
+                    emit_token(str(consecutive_item_count))
+                    item_count += consecutive_item_count
+                    if stats is not None:
+                        stats._add_run(depth,consecutive_item_count)
+                    consecutive_item_count = 0
+                emit_token(queue_token)
+                queue.append(children)
+                if stats is not None:
+                    stats._add_list(depth+1)
+                    depths.append(depth+1)
+            else:
+                consecutive_item_count += 1
+                emit_value(item)
+        if consecutive_item_count > 0:
+            emit_token(str(consecutive_item_count))
+            item_count += consecutive_item_count
+            if stats is not None:
+                stats._add_run(depth,consecutive_item_count)
             consecutive_item_count = 0
-            pattern_list.append(directive_token_map[item])
+        if len(queue) > 0:
+            emit_token(serve)
+    return item_count
+
+pattern_token_regex = re.compile('(['+re.escape(''.join(directive_token_map.values()))+'])')
+
+#binary encoding: a flags byte followed by one varint per token
+#directives are encoded as NestDirective.value-1 (a single byte) and a number n as the varint of n+5
+ENCODED_DFS_FLAG = 1
+ENCODED_BFS_FLAG = 2
+_encoded_tokens = tuple([NestDirective(code+1) for code in range(5)] + list(range(123)))
+
+def encode_pattern(structure_pattern):
+    """
+    Encodes a structure pattern (dfs or bfs) in the compact binary form accepted by every function taking a structure pattern
+
+    Numbers are stored as varints and nest directives as single bytes, so numbers below 123 take one byte.
+
+    >>> encode_pattern('1[2[1]3]3[2]')
+    b'\\x01\\x06\\x00\\x07\\x00\\x06\\x01\\x08\\x01\\x08\\x00\\x07\\x01'
+    >>> decode_pattern(encode_pattern('1*3*|2*3|2|1'))
+    '1*3*|2*3|2|1'
+    """
+    if isinstance(structure_pattern,(bytes,bytearray)):
+        return bytes(structure_pattern)
+    flags = 0
+    encoded = bytearray([0])
+    for directive in parse_pattern(structure_pattern):
+        if isinstance(directive,NestDirective):
+            if directive in (NestDirective.DFS_PUSH,NestDirective.DFS_POP):
+                flags |= ENCODED_DFS_FLAG
+            elif directive in (NestDirective.BFS_QUEUE,NestDirective.BFS_SERVE):
+                flags |= ENCODED_BFS_FLAG
+            encoded.append(directive.value-1)
         else:
-            consecutive_item_count += 1
-            flat_list.append(item)
-    if consecutive_item_count > 0:
-        pattern_list.append(str(consecutive_item_count))
-    structure_pattern = ''.join(pattern_list)
-    return (structure_pattern,flat_list)
+            value = directive+5
+            while value >= 0x80:
+                encoded.append((value & 0x7f) | 0x80)
+                value >>= 7
+            encoded.append(value)
+    encoded[0] = flags
+    return bytes(encoded)
+
+def _parse_encoded_header(encoded):
+    """
+    Returns the flags byte of a binary encoded pattern
+    """
+    if len(encoded) == 0 or encoded[0] > (ENCODED_DFS_FLAG | ENCODED_BFS_FLAG):
+        raise Exception('Encoded structure pattern has an invalid header')
+    return encoded[0]
+
+def _parse_encoded_pattern(encoded):
+    """
+    parse_pattern for the binary encoding
+    """
+    _parse_encoded_header(encoded)
+    body = bytes(encoded[1:])
+    if body.isascii():
+        #no multi-byte varints
+        return [_encoded_tokens[byte] for byte in body]
+    structure_directives = []
+    value = 0
+    shift = 0
+    for byte in body:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            structure_directives.append(_encoded_tokens[value] if value < 5 else value-5)
+            value = 0
+            shift = 0
+    if shift != 0:
+        raise Exception('Encoded structure pattern ends inside a number')
+    return structure_directives
+
+def decode_pattern(encoded):
+    """
+    Converts a binary encoded structure pattern back to the pattern string
+
+    >>> decode_pattern(encode_pattern('1[200[1]3]3[2]'))
+    '1[200[1]3]3[2]'
+    """
+    return ''.join([(directive_token_map[directive] if isinstance(directive,NestDirective) else str(directive)) for directive in _parse_encoded_pattern(encoded)])
 
 def parse_pattern(structure_pattern):
     """
     Splits the structure pattern into integers and nest directive enum values
+
+    A compiled StructurePattern may be given in place of a pattern string, in which case its already parsed directives are returned
+    A binary encoded pattern (see encode_pattern) is decoded directly
+    """
+    if isinstance(structure_pattern,StructurePattern):
+        return list(structure_pattern.directives)
+    directives = pattern_cache.directives(structure_pattern)
+    if directives is not None:
+        return list(directives)
+    return _parse_pattern(structure_pattern)
+
+def _parse_pattern(structure_pattern):
+    """
+    parse_pattern for a pattern string or binary encoded pattern, without the cache
+    """
+    if isinstance(structure_pattern,(bytes,bytearray)):
+        return _parse_encoded_pattern(structure_pattern)
+    return [(token_directive_map[token] if token in token_directive_map else int(token)) for token in pattern_token_regex.split(structure_pattern) if token != '']
+
+def iter_pattern_directives(pattern_chunks):
+    """
+    Incrementally splits a structure pattern into the same integers and nest directive enum values as parse_pattern
+
+    pattern_chunks is an iterable of strings (which may split numbers anywhere), a text file object (read in blocks), a pattern string, a binary encoded pattern or a StructurePattern
+
+    >>> list(iter_pattern_directives(['1[', '2[1', '0]3']))
+    [1, <NestDirective.DFS_PUSH: 1>, 2, <NestDirective.DFS_PUSH: 1>, 10, <NestDirective.DFS_POP: 2>, 3]
+    """
+    if isinstance(pattern_chunks,(bytes,bytearray,StructurePattern)):
+        for directive in parse_pattern(pattern_chunks):
+            yield directive
+        return
+    if isinstance(pattern_chunks,str):
+        pattern_chunks = [pattern_chunks]
+    elif hasattr(pattern_chunks,'read'):
+        pattern_file = pattern_chunks
+        pattern_chunks = iter(lambda: pattern_file.read(65536),'')
+    pending = ''
+    for chunk in pattern_chunks:
+        tokens = pattern_token_regex.split(pending+chunk)
+        #the last token is either empty or a number that may continue in the next chunk
+        pending = tokens.pop()
+        for token in tokens:
+            if token != '':
+                yield (token_directive_map[token] if token in token_directive_map else int(token))
+    if pending != '':
+        yield int(pending)
+
+class _PatternNode:
+    """
+    One nested list of a parsed structure pattern.
+
+    starts holds the nested index at which each entry begins.
+    entries holds, for each entry, either a run id (an int naming consecutive values) or the _PatternNode of a nested list
+    repeat is the number of consecutive copies of this nested list that the node stands for (see the repeat syntax).
+    size and offsets (the number of values before each entry, in dfs order) are only filled for patterns with repeats, as is levels (see _level_offsets).
+    """
+    __slots__ = ('parent','index','length','starts','entries','repeat','size','offsets','levels')
+    def __init__(self,parent=None,index=None,repeat=1):
+        self.parent = parent
+        self.index = index
+        self.length = 0
+        self.starts = []
+        self.entries = []
+        self.repeat = repeat
+    def add_node(self,repeat=1):
+        node = _PatternNode(self,self.length,repeat)
+        self.starts.append(self.length)
+        self.entries.append(node)
+        self.length += repeat
+        return node
+    def add_run(self,run_id,count):
+        self.starts.append(self.length)
+        self.entries.append(run_id)
+        self.length += count
+    def path(self):
+        nest_indices = []
+        node = self
+        while node.parent is not None:
+            nest_indices.append(node.index)
+            node = node.parent
+        nest_indices.reverse()
+        return nest_indices
+
+def _parse_tree(structure_directives):
+    """
+    Builds the tree of _PatternNode objects of a parsed structure pattern
+
+    Returns (top node, dfs or bfs, run nodes, run counts, run offsets, whether the pattern has repeats), indexed by run id in pattern order
+    """
+    top = _PatternNode()
+    run_nodes = []
+    run_counts = []
+    run_offsets = []
+    stackqueue = deque()
+    node = top
+    alg = None
+    repeat = None
+    repeated = False
+    previous = None
+    for directive in structure_directives:
+        if repeat is not None and directive is not NestDirective.DFS_PUSH and directive is not NestDirective.BFS_QUEUE:
+            raise Exception('A repeat count must be followed by a nested list')
+        if directive is NestDirective.DFS_PUSH:
+            if alg is bfs:
+                raise Exception('Structure pattern contains both dfs and bfs tokens')
+            alg = dfs
+            stackqueue.append(node)
+            node = node.add_node(repeat or 1)
+            repeat = None
+        elif directive is NestDirective.DFS_POP:
+            if alg is bfs:
+                raise Exception('Structure pattern contains both dfs and bfs tokens')
+            alg = dfs
+            if len(stackqueue) == 0:
+                raise Exception('Structure pattern contains imbalanced directive tokens')
+            node = stackqueue.pop()
+        elif directive is NestDirective.BFS_QUEUE:
+            if alg is dfs:
+                raise Exception('Structure pattern contains both dfs and bfs tokens')
+            alg = bfs
+            stackqueue.append(node.add_node(repeat or 1))
+            repeat = None
+        elif directive is NestDirective.BFS_SERVE:
+            if alg is dfs:
+                raise Exception('Structure pattern contains both dfs and bfs tokens')
+            alg = bfs
+            if len(stackqueue) == 0:
+                raise Exception('Structure pattern contains imbalanced directive tokens')
+            node = stackqueue.popleft()
+        elif directive is NestDirective.REPEAT:
+            if isinstance(previous,NestDirective) or previous is None or previous <= 0:
+                raise Exception('A repeat count must be a positive number')
+            #the count was taken as a run of values, undo that
+            node.starts.pop()
+            node.entries.pop()
+            node.length -= previous
+            run_nodes.pop()
+            run_counts.pop()
+            run_offsets.pop()
+            repeat = previous
+            repeated = True
+        elif directive > 0:
+            run_nodes.append(node)
+            run_offsets.append(node.length)
+            run_counts.append(directive)
+            node.add_run(len(run_counts)-1,directive)
+        previous = directive
+    if len(stackqueue) != 0 or repeat is not None:
+        raise Exception('Structure pattern contains imbalanced directive tokens')
+    return (top,(bfs if alg is bfs else dfs),run_nodes,run_counts,run_offsets,repeated)
+
+def _size_template(top,run_counts):
+    """
+    Fills size and offsets of every node of a tree with repeats and returns the number of values
+    """
+    nodes = [top]
+    for node in nodes:
+        nodes.extend([entry for entry in node.entries if isinstance(entry,_PatternNode)])
+    for node in reversed(nodes):
+        offsets = []
+        size = 0
+        for entry in node.entries:
+            offsets.append(size)
+            size += (entry.size*entry.repeat if isinstance(entry,_PatternNode) else run_counts[entry])
+        node.offsets = offsets
+        node.size = size
+        node.levels = {}
+    return top.size
+
+def _level_offsets(node,depth,run_counts):
+    """
+    For a node of a tree with repeats, returns the number of values depth levels below the node that come before each of its entries in bfs order, followed by the total
+
+    depth 0 counts the values of the runs of the node itself, depth 1 those of its nested lists (times their repeat count), and so on, all within one copy of the node.
+    The lists are kept in node.levels, so each is computed once.
+    """
+    stack = [(node,depth)]
+    while len(stack) > 0:
+        current,current_depth = stack[-1]
+        if current_depth in current.levels:
+            stack.pop()
+            continue
+        if current_depth == 0:
+            counts = [(0 if isinstance(entry,_PatternNode) else run_counts[entry]) for entry in current.entries]
+        else:
+            missing = [(entry,current_depth-1) for entry in current.entries if isinstance(entry,_PatternNode) and current_depth-1 not in entry.levels]
+            if len(missing) > 0:
+                stack.extend(missing)
+                continue
+            counts = [(entry.repeat*entry.levels[current_depth-1][-1] if isinstance(entry,_PatternNode) else 0) for entry in current.entries]
+        offsets = [0]
+        for count in counts:
+            offsets.append(offsets[-1]+count)
+        current.levels[current_depth] = offsets
+        stack.pop()
+    return node.levels[depth]
+
+def _template_level_starts(top,run_counts):
     """
-    return [(token_directive_map[token] if token in token_directive_map else int(token)) for token in re.split('(['+re.escape(''.join(directive_token_map.values()))+'])',structure_pattern) if token != '']
+    Returns the flat index at which each level of a tree with repeats begins in bfs order, followed by the number of values
+    """
+    starts = [0]
+    level = [(top,1)]
+    while len(level) > 0:
+        starts.append(starts[-1]+sum([copies*_level_offsets(node,0,run_counts)[-1] for node,copies in level]))
+        level = [(entry,copies*entry.repeat) for node,copies in level for entry in node.entries if isinstance(entry,_PatternNode)]
+    return starts
+
+def _expand_tree(template,template_run_counts):
+    """
+    Copies a tree with repeats into a tree where every repeated nested list is present as many times as it is repeated
+
+    Returns (top node, run nodes, run counts, run offsets)
+    """
+    top = _PatternNode()
+    run_nodes = []
+    run_counts = []
+    run_offsets = []
+    queue = deque([(template,top)])
+    while len(queue) > 0:
+        source,node = queue.popleft()
+        for entry in source.entries:
+            if isinstance(entry,_PatternNode):
+                for _ in range(entry.repeat):
+                    queue.append((entry,node.add_node()))
+            else:
+                run_nodes.append(node)
+                run_offsets.append(node.length)
+                run_counts.append(template_run_counts[entry])
+                node.add_run(len(run_counts)-1,template_run_counts[entry])
+    return (top,run_nodes,run_counts,run_offsets)
+
+def _flat_order(top,run_counts,algorithm):
+    """
+    Returns (run ids in the flat order of the algorithm, flat offset of each of them, flat offset of every run by run id)
+    """
+    flat_runs = list(_iter_pattern_runs(top,algorithm))
+    flat_starts = []
+    run_flat = [0]*len(run_counts)
+    size = 0
+    for run_id in flat_runs:
+        flat_starts.append(size)
+        run_flat[run_id] = size
+        size += run_counts[run_id]
+    return (flat_runs,flat_starts,run_flat)
+
+#guards the parts of a StructurePattern built on first use, which may be shared between threads through the pattern cache
+_lazy_lock = threading.RLock()
+
+#attributes of StructurePattern that a pattern with repeats only builds when first used
+_expanded_index_attributes = frozenset(['_top','_run_nodes','_run_counts','_run_offsets','_flat_runs','_flat_starts','_run_flat'])
+
+class StructurePattern:
+    """
+    A structure pattern (dfs or bfs) that has been parsed once into an index.
+
+    The index stores the flat offset of every run of consecutive values and, for every nested list, the nested index at which each of its entries begins.
+    Converting between flat and nested indices is then a binary search per nesting level instead of a scan over the whole pattern.
+
+    For a pattern with repeats (e.g. '1000x[1000]') the compressed tree is kept instead, and index conversion (dfs or bfs) is closed form arithmetic over the repeated nested lists.
+    The run index (used by NestedView, permutations, subtrees, ...) is then built by expanding the repeats on first use.
+
+    Every module level function taking a structure pattern also accepts a StructurePattern.
+
+    >>> p = StructurePattern('1[2[2[2]2]2]1')
+    >>> p.size
+    12
+    >>> p.get_nested_indices(6)
+    [1, 2, 2, 1]
+    >>> p.get_flat_index([1,4])
+    10
+    >>> p.as_bfs()
+    StructurePattern('1*1|2*2|2*2|2')
+    >>> p.as_bfs().get_flat_index([1,2,2,1])
+    11
+    >>> StructurePattern('1000x[1000]').get_nested_indices(123456)
+    [123, 456]
+    >>> StructurePattern('1000x*|1000').get_flat_index([123,456])
+    123456
 
-def deflatten(structure_pattern,flat_list):
+    """
+    def __init__(self,structure_pattern):
+        if isinstance(structure_pattern,StructurePattern):
+            structure_pattern = structure_pattern.pattern
+        self._directives = tuple(parse_pattern(structure_pattern))
+        if isinstance(structure_pattern,(bytes,bytearray)):
+            structure_pattern = decode_pattern(structure_pattern)
+        self.pattern = structure_pattern
+        self._counterpart = None
+        self._tables = None
+        self._permutation = None
+        self._expanded_from = None
+        top,self.algorithm,run_nodes,run_counts,run_offsets,repeated = _parse_tree(self._directives)
+        if repeated:
+            self._template = top
+            self._template_run_counts = run_counts
+            self.size = _size_template(top,run_counts)
+            self._template_level_starts = _template_level_starts(top,run_counts)
+            return
+        self._template = None
+        self._top = top
+        self._run_nodes = run_nodes
+        self._run_counts = run_counts
+        self._run_offsets = run_offsets
+        #runs appear in the pattern in flat order, so run ids are already sorted by flat offset
+        self._flat_runs = None
+        self._flat_starts = self._run_flat = []
+        size = 0
+        for count in run_counts:
+            self._run_flat.append(size)
+            size += count
+        self.size = size
+
+    def __getattr__(self,name):
+        if name in _expanded_index_attributes and self.__dict__.get('_template') is not None:
+            with _lazy_lock:
+                if name not in self.__dict__:
+                    self._expand()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def _expand(self):
+        """
+        Builds the run index of a pattern with repeats
+
+        Every table is built before any is stored, so threads reading the tables without the lock never see them half built.
+        """
+        if self._expanded_from is not None:
+            source = self._expanded_from
+            top,run_nodes,run_counts,run_offsets = source._top,source._run_nodes,source._run_counts,source._run_offsets
+        else:
+            top,run_nodes,run_counts,run_offsets = _expand_tree(self._template,self._template_run_counts)
+        flat_runs,flat_starts,run_flat = _flat_order(top,run_counts,self.algorithm)
+        self.__dict__.update({'_top':top,'_run_nodes':run_nodes,'_run_counts':run_counts,'_run_offsets':run_offsets,'_flat_runs':flat_runs,'_flat_starts':flat_starts,'_run_flat':run_flat})
+
+    @classmethod
+    def _from_tree(cls,source,algorithm):
+        """
+        Builds the other traversal order of source, sharing its parsed tree
+        """
+        self = cls.__new__(cls)
+        self._counterpart = source
+        self._tables = None
+        self._permutation = None
+        self._directives = None
+        self.algorithm = algorithm
+        self.size = source.size
+        self._template = source._template
+        if self._template is not None:
+            self._template_run_counts = source._template_run_counts
+            self._template_level_starts = source._template_level_starts
+            self._expanded_from = source
+            self.pattern = _render_pattern(self._template,self._template_run_counts,algorithm)
+            return self
+        self._expanded_from = None
+        self._top = source._top
+        self._run_nodes = source._run_nodes
+        self._run_counts = source._run_counts
+        self._run_offsets = source._run_offsets
+        self._flat_runs,self._flat_starts,self._run_flat = _flat_order(self._top,self._run_counts,algorithm)
+        self.pattern = _render_pattern(self._top,self._run_counts,algorithm)
+        return self
+
+    @property
+    def directives(self):
+        """
+        The parsed integers and NestDirective values, as a tuple
+        """
+        if self._directives is None:
+            self._directives = tuple(parse_pattern(self.pattern))
+        return self._directives
+
+    def __repr__(self):
+        return 'StructurePattern('+repr(self.pattern)+')'
+    def __str__(self):
+        return self.pattern
+    def __len__(self):
+        return self.size
+    def __eq__(self,other):
+        return isinstance(other,StructurePattern) and self.pattern == other.pattern
+    def __ne__(self,other):
+        return not self == other
+    def __hash__(self):
+        return hash(self.pattern)
+
+    def as_dfs(self):
+        """
+        Returns the depth-first search form of this pattern
+        """
+        if self.algorithm is dfs:
+            return self
+        if self._counterpart is None:
+            with _lazy_lock:
+                if self._counterpart is None:
+                    self._counterpart = StructurePattern._from_tree(self,dfs)
+        return self._counterpart
+    def as_bfs(self):
+        """
+        Returns the breadth-first search form of this pattern
+        """
+        if self.algorithm is bfs or is_bfs_pattern(self.pattern):
+            return self
+        if self._counterpart is None:
+            with _lazy_lock:
+                if self._counterpart is None:
+                    self._counterpart = StructurePattern._from_tree(self,bfs)
+        return self._counterpart
+
+    def get_nested_indices(self,flat_index):
+        """
+        Same as the module level get_nested_indices function
+        """
+        if flat_index < 0:
+            flat_index += self.size
+        if not 0 <= flat_index < self.size:
+            raise Exception('flat index exceeds size implied by structure pattern')
+        if self._template is not None:
+            if self.algorithm is dfs:
+                return self._get_template_nested_indices(flat_index)
+            return self._get_template_bfs_nested_indices(flat_index)
+        position = bisect_right(self._flat_starts,flat_index)-1
+        run_id = position if self._flat_runs is None else self._flat_runs[position]
+        nest_indices = self._run_nodes[run_id].path()
+        nest_indices.append(self._run_offsets[run_id] + flat_index - self._flat_starts[position])
+        return nest_indices
+
+    def get_flat_index(self,nest_indices):
+        """
+        Same as the module level get_flat_index function
+        """
+        if self._template is not None:
+            if self.algorithm is dfs:
+                return self._get_template_flat_index(nest_indices)
+            return self._get_template_bfs_flat_index(nest_indices)
+        node = self._top
+        last = len(nest_indices)-1
+        for depth,index in enumerate(nest_indices):
+            if not 0 <= index < node.length:
+                break
+            position = bisect_right(node.starts,index)-1
+            entry = node.entries[position]
+            if isinstance(entry,_PatternNode):
+                if depth == last:
+                    break
+                node = entry
+            else:
+                if depth != last:
+                    break
+                return self._run_flat[entry] + index - node.starts[position]
+        raise Exception('The provided nest indices do not exist in the structure pattern')
+
+    def _get_template_nested_indices(self,flat_index):
+        """
+        get_nested_indices in dfs order for a pattern with repeats, dividing by the size of repeated nested lists
+        """
+        nest_indices = []
+        node = self._template
+        while True:
+            position = bisect_right(node.offsets,flat_index)-1
+            entry = node.entries[position]
+            flat_index -= node.offsets[position]
+            if not isinstance(entry,_PatternNode):
+                nest_indices.append(node.starts[position]+flat_index)
+                return nest_indices
+            copy,flat_index = divmod(flat_index,entry.size)
+            nest_indices.append(node.starts[position]+copy)
+            node = entry
+
+    def _get_template_flat_index(self,nest_indices):
+        """
+        get_flat_index in dfs order for a pattern with repeats, multiplying by the size of repeated nested lists
+        """
+        node = self._template
+        flat_index = 0
+        last = len(nest_indices)-1
+        for depth,index in enumerate(nest_indices):
+            if not 0 <= index < node.length:
+                break
+            position = bisect_right(node.starts,index)-1
+            entry = node.entries[position]
+            flat_index += node.offsets[position]
+            if isinstance(entry,_PatternNode):
+                if depth == last:
+                    break
+                flat_index += (index-node.starts[position])*entry.size
+                node = entry
+            else:
+                if depth != last:
+                    break
+                return flat_index + index - node.starts[position]
+        raise Exception('The provided nest indices do not exist in the structure pattern')
+
+    def _get_template_bfs_nested_indices(self,flat_index):
+        """
+        get_nested_indices in bfs order for a pattern with repeats
+
+        The level of the value is found from the level starts, then at each nested list the entry holding it is found among the values of that level below each entry,
+        and the copy of a repeated nested list by dividing by the values of that level below one copy.
+        """
+        depth = bisect_right(self._template_level_starts,flat_index)-1
+        flat_index -= self._template_level_starts[depth]
+        run_counts = self._template_run_counts
+        nest_indices = []
+        node = self._template
+        while depth > 0:
+            offsets = _level_offsets(node,depth,run_counts)
+            position = bisect_right(offsets,flat_index)-1
+            entry = node.entries[position]
+            copy,flat_index = divmod(flat_index-offsets[position],_level_offsets(entry,depth-1,run_counts)[-1])
+            nest_indices.append(node.starts[position]+copy)
+            node = entry
+            depth -= 1
+        offsets = _level_offsets(node,0,run_counts)
+        position = bisect_right(offsets,flat_index)-1
+        nest_indices.append(node.starts[position]+flat_index-offsets[position])
+        return nest_indices
+
+    def _get_template_bfs_flat_index(self,nest_indices):
+        """
+        get_flat_index in bfs order for a pattern with repeats, the inverse of _get_template_bfs_nested_indices
+        """
+        run_counts = self._template_run_counts
+        node = self._template
+        flat_index = 0
+        last = len(nest_indices)-1
+        for depth,index in enumerate(nest_indices):
+            if not 0 <= index < node.length:
+                break
+            position = bisect_right(node.starts,index)-1
+            entry = node.entries[position]
+            flat_index += _level_offsets(node,last-depth,run_counts)[position]
+            if isinstance(entry,_PatternNode):
+                if depth == last:
+                    break
+                flat_index += (index-node.starts[position])*_level_offsets(entry,last-depth-1,run_counts)[-1]
+                node = entry
+            else:
+                if depth != last:
+                    break
+                return self._template_level_starts[last] + flat_index + index - node.starts[position]
+        raise Exception('The provided nest indices do not exist in the structure pattern')
+
+    def _get_node(self,nest_indices):
+        """
+        Returns the _PatternNode of the nested list at the sequence of nested indices
+        """
+        node = self._top
+        for index in nest_indices:
+            if not 0 <= index < node.length:
+                raise Exception('The provided nest indices do not exist in the structure pattern')
+            entry = node.entries[bisect_right(node.starts,index)-1]
+            if not isinstance(entry,_PatternNode):
+                raise Exception('The provided nest indices do not refer to a nested list')
+            node = entry
+        return node
+
+    def _get_node_flat_start(self,node):
+        """
+        Returns the flat index at which the values of a nested list begin in dfs order (only meaningful for dfs)
+        """
+        for run_id in _iter_pattern_runs(node,dfs):
+            return self._run_flat[run_id]
+        #no values inside: the position is that of the next value after the nested list
+        while node.parent is not None:
+            parent = node.parent
+            for entry in parent.entries[bisect_right(parent.starts,node.index):]:
+                if isinstance(entry,_PatternNode):
+                    for run_id in _iter_pattern_runs(entry,dfs):
+                        return self._run_flat[run_id]
+                else:
+                    return self._run_flat[entry]
+            node = parent
+        return self.size
+
+    def get_subtree(self,nest_indices):
+        """
+        Same as the module level get_subtree function, returning the sub-pattern as a string
+        """
+        node = self._get_node(nest_indices)
+        sub_pattern = _render_pattern(node,self._run_counts,self.algorithm)
+        flat_ranges = []
+        for run_id in _iter_pattern_runs(node,self.algorithm):
+            start = self._run_flat[run_id]
+            stop = start + self._run_counts[run_id]
+            if len(flat_ranges) > 0 and flat_ranges[-1][1] == start:
+                flat_ranges[-1] = (flat_ranges[-1][0],stop)
+            else:
+                flat_ranges.append((start,stop))
+        if self.algorithm is bfs:
+            return (sub_pattern,flat_ranges)
+        if len(flat_ranges) == 0:
+            start = self._get_node_flat_start(node)
+            return (sub_pattern,(start,start))
+        return (sub_pattern,flat_ranges[0])
+
+    def get_permutation(self):
+        """
+        Returns an array.array perm such that item i of a flat list in this pattern's order is item perm[i] of the flat list in the other order (dfs vs bfs)
+
+        The permutation is built in one pass over the runs of the pattern and cached; a copy of the cached array is returned
+        """
+        return self._get_permutation()[:]
+
+    def _get_permutation(self):
+        """
+        get_permutation without the copy, for callers that only read the permutation
+        """
+        if self._permutation is None:
+            other = self.as_bfs() if self.algorithm is dfs else self.as_dfs()
+            permutation = array('q')
+            for run_id in (range(len(self._run_counts)) if self._flat_runs is None else self._flat_runs):
+                start = other._run_flat[run_id]
+                permutation.extend(range(start,start+self._run_counts[run_id]))
+            self._permutation = permutation
+        return self._permutation
+
+    def _entry_tables(self):
+        """
+        Returns the nested index of this pattern as flat int64 arrays (array.array('q')), keyed by name
+
+        Nested lists are numbered in bfs order (the top level is 0) and node_base[n] is the sum of the lengths of the lists numbered before n.
+        Every entry (run or nested list) of list n that begins at nested index i is keyed by node_base[n]+i, so entry_keys is sorted and an entry is found with one binary search.
+        entry_child holds the number of the nested list of an entry (-1 for runs) and entry_flat holds flat index minus nested index for the values of a run.
+        """
+        node_base = array('q')
+        node_length = array('q')
+        entry_keys = array('q')
+        entry_child = array('q')
+        entry_flat = array('q')
+        base = 0
+        node_count = 1
+        queue = deque([self._top])
+        while len(queue) > 0:
+            node = queue.popleft()
+            node_base.append(base)
+            node_length.append(node.length)
+            for start,entry in zip(node.starts,node.entries):
+                entry_keys.append(base+start)
+                if isinstance(entry,_PatternNode):
+                    entry_child.append(node_count)
+                    entry_flat.append(-1)
+                    node_count += 1
+                    queue.append(entry)
+                else:
+                    entry_child.append(-1)
+                    entry_flat.append(self._run_flat[entry]-start)
+            base += node.length
+        return {'node_base':node_base,'node_length':node_length,'entry_keys':entry_keys,'entry_child':entry_child,'entry_flat':entry_flat}
+
+    def _batch_tables(self):
+        """
+        Builds (once) the numpy arrays used by the batch conversion methods
+        """
+        if self._tables is not None:
+            return self._tables
+        tables = {}
+        tables['flat_starts'] = _numpy.asarray(self._flat_starts,dtype=_numpy.int64)
+        if self._flat_runs is None:
+            tables['flat_runs'] = _numpy.arange(len(self._run_counts),dtype=_numpy.int64)
+        else:
+            tables['flat_runs'] = _numpy.asarray(self._flat_runs,dtype=_numpy.int64)
+        tables['run_flat'] = _numpy.asarray(self._run_flat,dtype=_numpy.int64)
+        for name,table in self._entry_tables().items():
+            tables[name] = _numpy.asarray(table,dtype=_numpy.int64)
+        #nested indices of the first value of every run, padded with -1
+        node_paths = {}
+        run_paths = []
+        for node,offset in zip(self._run_nodes,self._run_offsets):
+            if id(node) not in node_paths:
+                node_paths[id(node)] = node.path()
+            run_paths.append(node_paths[id(node)]+[offset])
+        width = max([len(path) for path in run_paths] or [1])
+        tables['run_depth'] = _numpy.asarray([len(path) for path in run_paths],dtype=_numpy.int64)
+        tables['run_paths'] = _numpy.asarray([path+[-1]*(width-len(path)) for path in run_paths],dtype=_numpy.int64).reshape(len(run_paths),width)
+        self._tables = tables
+        return tables
+
+    def _flat_positions_batch(self,flat_indices):
+        """
+        Returns (flat indices, positions into the sorted run starts) with negative flat indices resolved
+        """
+        tables = self._batch_tables()
+        flat_indices = _numpy.asarray(flat_indices,dtype=_numpy.int64).ravel()
+        flat_indices = _numpy.where(flat_indices < 0,flat_indices+self.size,flat_indices)
+        if ((flat_indices < 0) | (flat_indices >= self.size)).any():
+            raise Exception('flat index exceeds size implied by structure pattern')
+        return flat_indices,_numpy.searchsorted(tables['flat_starts'],flat_indices,side='right')-1
+
+    def get_nested_indices_batch(self,flat_indices):
+        """
+        Same as the module level get_nested_indices_batch function
+        """
+        if _numpy is None:
+            nest_indices = [self.get_nested_indices(flat_index) for flat_index in flat_indices]
+            width = max([len(row) for row in nest_indices] or [0])
+            return [row+[-1]*(width-len(row)) for row in nest_indices]
+        tables = self._batch_tables()
+        flat_indices,positions = self._flat_positions_batch(flat_indices)
+        runs = tables['flat_runs'][positions]
+        depths = tables['run_depth'][runs]
+        width = int(depths.max()) if len(depths) > 0 else 0
+        nest_indices = tables['run_paths'][runs,:width]
+        nest_indices[_numpy.arange(len(runs)),depths-1] += flat_indices - tables['flat_starts'][positions]
+        return nest_indices
+
+    def get_flat_index_batch(self,nest_indices):
+        """
+        Same as the module level get_flat_index_batch function
+        """
+        if _numpy is None:
+            return [self.get_flat_index([index for index in row if index >= 0]) for row in nest_indices]
+        tables = self._batch_tables()
+        if not isinstance(nest_indices,_numpy.ndarray):
+            nest_indices = [list(row) for row in nest_indices]
+            width = max([len(row) for row in nest_indices] or [0])
+            nest_indices = [row+[-1]*(width-len(row)) for row in nest_indices]
+        nest_indices = _numpy.asarray(nest_indices,dtype=_numpy.int64)
+        if len(nest_indices) == 0:
+            return _numpy.zeros(0,dtype=_numpy.int64)
+        nest_indices = nest_indices.reshape(len(nest_indices),-1)
+        depths = (nest_indices >= 0).sum(axis=1)
+        flat_indices = _numpy.full(len(nest_indices),-1,dtype=_numpy.int64)
+        nodes = _numpy.zeros(len(nest_indices),dtype=_numpy.int64)
+        if (depths == 0).any():
+            raise Exception('The provided nest indices do not exist in the structure pattern')
+        for column in range(nest_indices.shape[1]):
+            rows = _numpy.nonzero(depths > column)[0]
+            if len(rows) == 0:
+                break
+            indices = nest_indices[rows,column]
+            row_nodes = nodes[rows]
+            if ((indices < 0) | (indices >= tables['node_length'][row_nodes])).any():
+                raise Exception('The provided nest indices do not exist in the structure pattern')
+            entries = _numpy.searchsorted(tables['entry_keys'],tables['node_base'][row_nodes]+indices,side='right')-1
+            children = tables['entry_child'][entries]
+            last = depths[rows] == column+1
+            if ((last & (children >= 0)) | (~last & (children < 0))).any():
+                raise Exception('The provided nest indices do not exist in the structure pattern')
+            nodes[rows] = children
+            flat_indices[rows[last]] = tables['entry_flat'][entries[last]] + indices[last]
+        return flat_indices
+
+    def _convert_flat_indices_batch(self,target,flat_indices):
+        """
+        Maps flat indices of this pattern onto flat indices of target, another traversal order of the same pattern
+        """
+        if _numpy is None:
+            result = []
+            for flat_index in flat_indices:
+                if flat_index < 0:
+                    flat_index += self.size
+                if not 0 <= flat_index < self.size:
+                    raise Exception('flat index exceeds size implied by structure pattern')
+                position = bisect_right(self._flat_starts,flat_index)-1
+                run_id = position if self._flat_runs is None else self._flat_runs[position]
+                result.append(target._run_flat[run_id] + flat_index - self._flat_starts[position])
+            return result
+        tables = self._batch_tables()
+        flat_indices,positions = self._flat_positions_batch(flat_indices)
+        runs = tables['flat_runs'][positions]
+        return target._batch_tables()['run_flat'][runs] + flat_indices - tables['flat_starts'][positions]
+
+def _iter_pattern_runs(top,algorithm):
+    """
+    Yields the run ids of a parsed pattern tree in the flat order of the algorithm (dfs or bfs)
+    """
+    if algorithm is dfs:
+        stack = [iter(top.entries)]
+        while len(stack) > 0:
+            for entry in stack[-1]:
+                if isinstance(entry,_PatternNode):
+                    stack.append(iter(entry.entries))
+                    break
+                yield entry
+            else:
+                stack.pop()
+    else:
+        queue = deque([top])
+        while len(queue) > 0:
+            for entry in queue.popleft().entries:
+                if isinstance(entry,_PatternNode):
+                    queue.append(entry)
+                else:
+                    yield entry
+
+def _render_pattern(top,run_counts,algorithm):
+    """
+    Produces the pattern string of a parsed pattern tree in the form of the algorithm (dfs or bfs)
+    """
+    repeat_token = directive_token_map[NestDirective.REPEAT]
+    if algorithm is dfs:
+        push = directive_token_map[NestDirective.DFS_PUSH]
+        pop = directive_token_map[NestDirective.DFS_POP]
+        tokens = []
+        stack = [iter(top.entries)]
+        while len(stack) > 0:
+            for entry in stack[-1]:
+                if isinstance(entry,_PatternNode):
+                    if entry.repeat != 1:
+                        tokens.append(str(entry.repeat)+repeat_token)
+                    tokens.append(push)
+                    stack.append(iter(entry.entries))
+                    break
+                tokens.append(str(run_counts[entry]))
+            else:
+                stack.pop()
+                if len(stack) > 0:
+                    tokens.append(pop)
+        return ''.join(tokens)
+    queue_token = directive_token_map[NestDirective.BFS_QUEUE]
+    groups = []
+    queue = deque([top])
+    while len(queue) > 0:
+        tokens = []
+        for entry in queue.popleft().entries:
+            if isinstance(entry,_PatternNode):
+                if entry.repeat != 1:
+                    tokens.append(str(entry.repeat)+repeat_token)
+                tokens.append(queue_token)
+                queue.append(entry)
+            else:
+                tokens.append(str(run_counts[entry]))
+        groups.append(''.join(tokens))
+    return directive_token_map[NestDirective.BFS_SERVE].join(groups)
+
+def expand_pattern(structure_pattern):
+    """
+    Returns the pattern with every repeated nested list written out
+
+    >>> expand_pattern('1[2x[3]]2x[1]')
+    '1[[3][3]][1][1]'
+    >>> expand_pattern('2x*|2x*|1')
+    '**|**|**|1|1|1|1'
+
+    """
+    structure_directives = parse_pattern(structure_pattern)
+    if NestDirective.REPEAT not in structure_directives:
+        return structure_pattern
+    top,algorithm,run_nodes,run_counts,run_offsets,repeated = _parse_tree(structure_directives)
+    top,run_nodes,run_counts,run_offsets = _expand_tree(top,run_counts)
+    return _same_kind(structure_pattern,_render_pattern(top,run_counts,algorithm))
+
+def compress_pattern(structure_pattern):
+    """
+    Returns the pattern (dfs or bfs) with consecutive nested lists of the same shape written once with a repeat count
+
+    A regular structure then has a pattern whose length does not grow with its size.
+
+    >>> compress_pattern('[3][3][3]')
+    '3x[3]'
+    >>> compress_pattern('2[3][3][3]')
+    '2[3]2x[3]'
+    >>> compress_pattern(flatten([[[0]*10]*10]*10)[0])
+    '10x[10x[10]]'
+    >>> compress_pattern('1*1|2*2|2*2|2')
+    '1*1|2*2|2*2|2'
+
+    """
+    structure_directives = parse_pattern(structure_pattern)
+    top,algorithm,run_nodes,run_counts,run_offsets,repeated = _parse_tree(structure_directives)
+    nodes = [top]
+    for node in nodes:
+        nodes.extend([entry for entry in node.entries if isinstance(entry,_PatternNode)])
+    #give every nested list a shape id, children before their parents, merging runs of children with the same shape
+    shapes = {}
+    shape_ids = {}
+    for node in reversed(nodes):
+        starts = []
+        entries = []
+        shape = []
+        for entry in node.entries:
+            if isinstance(entry,_PatternNode):
+                key = shape_ids[id(entry)]
+                #a repeat count directly after a run of values would be read as part of that number
+                if len(entries) > 0 and isinstance(entries[-1],_PatternNode) and shape[-1][0] == key and (len(entries) == 1 or isinstance(entries[-2],_PatternNode)):
+                    entries[-1].repeat += entry.repeat
+                    shape[-1] = (key,entries[-1].repeat)
+                    continue
+                shape.append((key,entry.repeat))
+            else:
+                shape.append(run_counts[entry])
+            starts.append(len(entries))
+            entries.append(entry)
+        node.starts = starts
+        node.entries = entries
+        shape_ids[id(node)] = shapes.setdefault(tuple(shape),len(shapes))
+    compressed = _render_pattern(top,run_counts,algorithm)
+    return _same_kind(structure_pattern,compressed)
+
+def pattern_stats(structure_pattern):
+    """
+    Returns the TraversalStats of the structure described by a pattern (dfs or bfs), without building it
+
+    Repeated nested lists are counted without being expanded.
+
+    >>> pattern_stats('1*1|2*2|2*2|2')
+    TraversalStats(lists=4, leaves=12, max_depth=3, level_lists=[1, 1, 1, 1], level_items=[3, 5, 5, 2], largest_run=2)
+    >>> pattern_stats('1000x[1000]')
+    TraversalStats(lists=1001, leaves=1000000, max_depth=1, level_lists=[1, 1000], level_items=[1000, 1000000], largest_run=1000)
+
+    """
+    start = time.perf_counter()
+    top,algorithm,run_nodes,run_counts,run_offsets,repeated = _parse_tree(parse_pattern(structure_pattern))
+    stats = TraversalStats()
+    stats.level_lists = []
+    stats.level_items = []
+    stats.lists = 0
+    #(node, number of lists it stands for) for each nested list at the current depth
+    level = [(top,1)]
+    while len(level) > 0:
+        next_level = []
+        lists = 0
+        items = 0
+        for node,count in level:
+            lists += count
+            items += count*node.length
+            for entry in node.entries:
+                if isinstance(entry,_PatternNode):
+                    next_level.append((entry,count*entry.repeat))
+                else:
+                    stats.leaves += count*run_counts[entry]
+                    stats.largest_run = max(stats.largest_run,run_counts[entry])
+        stats.level_lists.append(lists)
+        stats.level_items.append(items)
+        stats.lists += lists
+        level = next_level
+    stats.max_depth = len(stats.level_lists)-1
+    stats.times['pattern_stats'] = time.perf_counter()-start
+    return stats
+
+def find_mismatch(structure_pattern,nested_structure):
+    """
+    Returns the nested indices of the first position (in dfs order) where the nested structure differs from the shape of the pattern (dfs or bfs), or None if it has that shape
+
+    The position is that of an item that should be a value but is a nested list or the reverse, of the first extra item of a list that is too long, or one past the end of a list that is too short.
+    Nested lists are lists and tuples, as for flatten. Nothing is flattened and the check stops at the first mismatch.
+
+    >>> find_mismatch('1[2[1]3]3[2]', [0,[1,2,[3],4,5,6],7,8,9,[10,11]]) is None
+    True
+    >>> find_mismatch('1[2[1]3]3[2]', [0,[1,2,3,4,5,6],7,8,9,[10,11]])
+    [1, 2]
+    >>> find_mismatch('1*3*|2*3|2|1', [0,[1,2,[3],4,5,6],7,8,9,[10]])
+    [5, 1]
+
+    """
+    structure_pattern = compile_pattern(structure_pattern)
+    #patterns with repeats are checked against the compressed tree, where a repeated nested list is one node
+    top = structure_pattern._template if structure_pattern._template is not None else structure_pattern._top
+    run_counts = structure_pattern._template_run_counts if structure_pattern._template is not None else structure_pattern._run_counts
+    if not isinstance(nested_structure,(list,tuple)):
+        return []
+    path = []
+    #frames of [pattern node, list, entry position, index of the next item to check]
+    stack = [[top,nested_structure,0,0]]
+    while len(stack) > 0:
+        frame = stack[-1]
+        node,items,position,index = frame
+        while position < len(node.entries):
+            entry = node.entries[position]
+            if isinstance(entry,_PatternNode):
+                if index < node.starts[position]+entry.repeat:
+                    if index >= len(items) or not isinstance(items[index],(list,tuple)):
+                        return path+[index]
+                    frame[2] = position
+                    frame[3] = index+1
+                    path.append(index)
+                    stack.append([entry,items[index],0,0])
+                    break
+            else:
+                stop = node.starts[position]+run_counts[entry]
+                for index in range(index,min(stop,len(items))):
+                    if isinstance(items[index],(list,tuple)):
+                        return path+[index]
+                if stop > len(items):
+                    return path+[len(items)]
+                index = stop
+            position += 1
+        else:
+            if len(items) > node.length:
+                return path+[node.length]
+            stack.pop()
+            if len(stack) > 0:
+                path.pop()
+    return None
+
+def matches(structure_pattern,nested_structure):
+    """
+    Checks that the nested structure has exactly the shape described by the pattern (dfs or bfs), see find_mismatch
+
+    >>> matches('1[2]', [0,[1,2]])
+    True
+    >>> matches('1[2]', [0,[1,[2]]])
+    False
+
+    """
+    return find_mismatch(structure_pattern,nested_structure) is None
+
+PatternCacheInfo = namedtuple('PatternCacheInfo',['hits','misses','evictions','maxsize','currsize','max_weight','weight'])
+
+def _expanded_length(top,run_counts):
+    """
+    Returns the length of the pattern string of a parsed pattern tree with every repeat written out (the same for its dfs and bfs forms)
+    """
+    nodes = [top]
+    for node in nodes:
+        nodes.extend([entry for entry in node.entries if isinstance(entry,_PatternNode)])
+    lengths = {}
+    for node in reversed(nodes):
+        #a nested list adds two tokens, '[' and ']' in dfs and '*' and '|' in bfs
+        lengths[id(node)] = sum([(entry.repeat*(2+lengths[id(entry)]) if isinstance(entry,_PatternNode) else len(str(run_counts[entry]))) for entry in node.entries])
+    return lengths[id(top)]
+
+class PatternCache:
+    """
+    A bounded, thread-safe, least recently used cache of parsed and compiled structure patterns
+
+    The module functions taking a pattern string or binary encoded pattern go through the module level pattern_cache,
+    so a pattern seen repeatedly is parsed once, compiled (see compile_pattern) once, and converted to its other form once (the compiled dfs and bfs forms of a pattern are linked).
+
+    maxsize bounds the number of patterns kept and max_weight their total weight; resize(0) disables the cache.
+    The weight of a pattern is its length, or for a compiled pattern with repeats the length of its written out form (see expand_pattern), since the memory held by a compiled pattern grows with that length.
+    Patterns longer than max_pattern_length are not cached, nor are patterns weighing more than max_weight, so a few very large patterns cannot hold on to memory.
+    All bookkeeping happens under a lock; a pattern missing from the cache is parsed outside the lock, so concurrent misses on the same pattern may parse it more than once but store one result.
+
+    >>> cache = PatternCache(maxsize=2)
+    >>> cache.compiled('1[2]') is cache.compiled('1[2]')
+    True
+    >>> cache.directives('3'), cache.directives('4'), cache.info()
+    ((3,), (4,), PatternCacheInfo(hits=1, misses=3, evictions=1, maxsize=2, currsize=2, max_weight=1048576, weight=2))
+    >>> cache.compiled('1000x[1000x[1]]') is cache.compiled('1000x[1000x[1]]')
+    False
+    >>> cache.clear()
+    >>> cache.info()
+    PatternCacheInfo(hits=0, misses=0, evictions=0, maxsize=2, currsize=0, max_weight=1048576, weight=0)
+
+    """
+    def __init__(self,maxsize=1024,max_pattern_length=1<<16,max_weight=1<<20):
+        self._lock = threading.Lock()
+        #key: [directives, StructurePattern, weight]
+        self._entries = OrderedDict()
+        self.maxsize = maxsize
+        self.max_pattern_length = max_pattern_length
+        self.max_weight = max_weight
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key(self,structure_pattern):
+        """
+        Returns the key of a pattern string or binary encoded pattern, or None if it is not to be cached
+        """
+        if self.maxsize <= 0 or len(structure_pattern) > self.max_pattern_length:
+            return None
+        if isinstance(structure_pattern,str):
+            return structure_pattern
+        if isinstance(structure_pattern,(bytes,bytearray)):
+            return bytes(structure_pattern)
+        return None
+
+    def _get(self,key,index):
+        """
+        Returns item index (0 for the directives, 1 for the StructurePattern) of the entry for key, or None, counting the hit or miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[index] is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[index]
+            self.misses += 1
+            return None
+
+    def _put(self,key,index,value,weight):
+        """
+        Stores value as item index of the entry for key and returns the stored value (an earlier one if another thread stored it first)
+
+        A value weighing more than max_weight is returned without being stored.
+        """
+        with self._lock:
+            if weight > self.max_weight:
+                return value
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [None,None,0]
+            else:
+                self._entries.move_to_end(key)
+            if entry[index] is None:
+                entry[index] = value
+            if weight > entry[2]:
+                self.weight += weight-entry[2]
+                entry[2] = weight
+            self._evict(key)
+            return entry[index]
+
+    def _evict(self,keep=None):
+        """
+        Removes least recently used entries (other than the one for keep) until the cache is within maxsize and max_weight
+        """
+        while len(self._entries) > max(self.maxsize,0) or self.weight > self.max_weight:
+            key,entry = self._entries.popitem(last=False)
+            if key == keep:
+                self._entries[key] = entry
+                break
+            self.weight -= entry[2]
+            self.evictions += 1
+
+    def directives(self,structure_pattern):
+        """
+        Returns the parsed directives of a pattern as a tuple, or None if the pattern is not cached (cache disabled or pattern too long)
+        """
+        key = self._key(structure_pattern)
+        if key is None:
+            return None
+        directives = self._get(key,0)
+        if directives is None:
+            directives = self._put(key,0,tuple(_parse_pattern(key)),len(key))
+        return directives
+
+    def compiled(self,structure_pattern):
+        """
+        Returns the StructurePattern of a pattern, or None if the pattern is not cached (cache disabled or pattern too long)
+        """
+        key = self._key(structure_pattern)
+        if key is None:
+            return None
+        compiled = self._get(key,1)
+        if compiled is None:
+            compiled = StructurePattern(key)
+            weight = len(key) if compiled._template is None else _expanded_length(compiled._template,compiled._template_run_counts)
+            compiled = self._put(key,1,compiled,weight)
+        return compiled
+
+    def clear(self):
+        """
+        Removes every pattern and resets the statistics
+        """
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def resize(self,maxsize,max_weight=None):
+        """
+        Changes the number of patterns kept (and, if given, their total weight), evicting the least recently used ones; 0 disables the cache
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            if max_weight is not None:
+                self.max_weight = max_weight
+            self._evict()
+
+    def info(self):
+        """
+        Returns the hit, miss and eviction counts, maxsize, current size, max_weight and current weight as a PatternCacheInfo
+        """
+        with self._lock:
+            return PatternCacheInfo(self.hits,self.misses,self.evictions,self.maxsize,len(self._entries),self.max_weight,self.weight)
+
+#the cache used by the module functions
+pattern_cache = PatternCache()
+
+def compile_pattern(structure_pattern):
+    """
+    Returns the StructurePattern for a pattern string (a StructurePattern is returned as is)
+
+    Compile a pattern once when converting many indices against it.
+    Patterns are also kept in pattern_cache (see PatternCache), so compiling a pattern seen before returns the same StructurePattern.
+    """
+    if isinstance(structure_pattern,StructurePattern):
+        return structure_pattern
+    compiled = pattern_cache.compiled(structure_pattern)
+    if compiled is not None:
+        return compiled
+    return StructurePattern(structure_pattern)
+
+def deflatten(structure_pattern,flat_list,stats=None,container_info=None,containers=None):
     """
     Given a structure pattern and a flat list, construct a nested list structure
 
@@ -166,15 +1982,41 @@ def deflatten(structure_pattern,flat_list):
     >>> deflatten('1*1|2*2|2*2|2', [1, 12, 2, 3, 10, 11, 4, 5, 8, 9, 6, 7])
     [1, [2, 3, [4, 5, [6, 7], 8, 9], 10, 11], 12]
 
-    """
+    stats has the same meaning as in the flatten function
 
+    container_info, as returned by flatten with a ContainerRegistry, rebuilds the recorded container types using containers (default standard_containers)
+
+    """
+    start = time.perf_counter()
     structure_directives = parse_pattern(structure_pattern)
+    if NestDirective.REPEAT in structure_directives:
+        structure_directives = _expand_directives(structure_directives)
+    collected = None if stats is None else TraversalStats()
+    if container_info is None:
+        nested_structure = _deflatten_values(structure_directives,iter(flat_list),stats=collected)
+    else:
+        created = []
+        nested_structure = _deflatten_values(structure_directives,iter(flat_list),created,collected)
+        nested_structure = (containers or standard_containers)._rebuild(nested_structure,created,container_info)
+    if stats is not None:
+        collected.times['deflatten'] = time.perf_counter()-start
+        _report_stats(stats,collected)
+    return nested_structure
+
+def _deflatten_values(structure_directives,values,created=None,stats=None):
+    """
+    deflatten for a sequence of parsed directives without repeats, taking the flat values from the iterator values as the pattern consumes them
 
+    When created is a list, (nested list, parent list, index in parent) is appended to it for each nested list made
+    When stats is a TraversalStats, the lists and runs are counted in it
+    """
     stackqueue = deque()
     nested_structure = []
     top_nested_structure = nested_structure
-    flat_position = 0
     alg = None
+    #depth of the current list and, in bfs, of each queued list, only kept for stats
+    depth = 0
+    depths = deque()
     for directive in structure_directives:
         if directive is NestDirective.DFS_PUSH:
             if alg is bfs:
@@ -183,42 +2025,300 @@ def deflatten(structure_pattern,flat_list):
             stackqueue.append(nested_structure)
             nested_structure = []
             stackqueue[-1].append(nested_structure)
-        elif directive is NestDirective.DFS_POP: 
+            if created is not None:
+                created.append((nested_structure,stackqueue[-1],len(stackqueue[-1])-1))
+            if stats is not None:
+                depth += 1
+                stats._add_list(depth)
+        elif directive is NestDirective.DFS_POP:
             if alg is bfs:
                 raise Exception('Structure pattern contains both dfs and bfs tokens')
             alg = dfs
+            if len(stackqueue) == 0:
+                raise Exception('Structure pattern contains imbalanced directive tokens')
             nested_structure = stackqueue.pop()
-        elif directive is NestDirective.BFS_QUEUE: 
+            depth -= 1
+        elif directive is NestDirective.BFS_QUEUE:
             if alg is dfs:
                 raise Exception('Structure pattern contains both dfs and bfs tokens')
             alg = bfs
             subtree = []
             stackqueue.append(subtree)
             nested_structure.append(subtree)
-        elif directive is NestDirective.BFS_SERVE: 
+            if created is not None:
+                created.append((subtree,nested_structure,len(nested_structure)-1))
+            if stats is not None:
+                stats._add_list(depth+1)
+                depths.append(depth+1)
+        elif directive is NestDirective.BFS_SERVE:
             if alg is dfs:
                 raise Exception('Structure pattern contains both dfs and bfs tokens')
             alg = bfs
+            if len(stackqueue) == 0:
+                raise Exception('Structure pattern contains imbalanced directive tokens')
             nested_structure = stackqueue.popleft()
+            if stats is not None:
+                depth = depths.popleft()
         else:
             #is a number -> consume that many items
-            if flat_position + directive <= len(flat_list):
-                nested_structure.extend(flat_list[flat_position:flat_position+directive])
-                flat_position += directive
-            else:
+            expected_length = len(nested_structure) + directive
+            nested_structure.extend(islice(values,directive))
+            if len(nested_structure) < expected_length:
                 raise Exception('structure_pattern implies more values than flat_list contains')
-    if flat_position < len(flat_list):
+            if stats is not None:
+                stats._add_run(depth,directive)
+    for _ in values:
         raise Exception('flat_list has more data than structure_pattern implies')
     if len(stackqueue) != 0:
         raise Exception('Structure pattern contains imbalanced directive tokens')
     return top_nested_structure
 
+def _expand_directives(structure_directives):
+    """
+    Returns the directives of a parsed pattern with every repeated nested list written out
+    """
+    top,algorithm,run_nodes,run_counts,run_offsets,repeated = _parse_tree(structure_directives)
+    if not repeated:
+        return structure_directives
+    top,run_nodes,run_counts,run_offsets = _expand_tree(top,run_counts)
+    return parse_pattern(_render_pattern(top,run_counts,algorithm))
+
+def _expand_streamed_repeats(structure_directives):
+    """
+    Expands the repeats of a stream of dfs directives, buffering one repeated nested list at a time
+    """
+    structure_directives = iter(structure_directives)
+    count = None
+    for directive in structure_directives:
+        if directive is NestDirective.REPEAT:
+            if not count:
+                raise Exception('A repeat count must be a positive number')
+            block = [next(structure_directives,None)]
+            if block[0] is NestDirective.BFS_QUEUE:
+                raise Exception('bfs patterns with repeats cannot be streamed, expand them first')
+            if block[0] is not NestDirective.DFS_PUSH:
+                raise Exception('A repeat count must be followed by a nested list')
+            depth = 1
+            while depth > 0:
+                block.append(next(structure_directives,None))
+                if block[-1] is None:
+                    raise Exception('Structure pattern contains imbalanced directive tokens')
+                if block[-1] is NestDirective.DFS_PUSH:
+                    depth += 1
+                elif block[-1] is NestDirective.DFS_POP:
+                    depth -= 1
+            block = _expand_directives(block)
+            for _ in range(count):
+                for expanded in block:
+                    yield expanded
+            count = None
+            continue
+        if count is not None:
+            yield count
+            count = None
+        #numbers are held back until the next token tells whether they are a repeat count
+        if isinstance(directive,NestDirective):
+            yield directive
+        else:
+            count = directive
+    if count is not None:
+        yield count
+
+def deflatten_stream(pattern_chunks,values):
+    """
+    Streaming form of deflatten that reads the structure pattern and the values incrementally
+
+    pattern_chunks is anything accepted by iter_pattern_directives (e.g. a text file object holding the pattern)
+    values is any iterable of the flat values; values are pulled from it as the pattern consumes them, so no flat list is built
+    (values written to a file by flatten_stream with the default value_encoder are read back with map(json.loads, file))
+
+    Repeats in a dfs pattern are expanded one repeated nested list at a time; bfs patterns with repeats must be expanded first (see expand_pattern)
+
+    >>> import io
+    >>> deflatten_stream(io.StringIO('1*1|2*2|2*2|2'), iter([1, 12, 2, 3, 10, 11, 4, 5, 8, 9, 6, 7]))
+    [1, [2, 3, [4, 5, [6, 7], 8, 9], 10, 11], 12]
+
+    """
+    return _deflatten_values(_expand_streamed_repeats(iter_pattern_directives(pattern_chunks)),iter(values))
+
+def flatten_many(records,algorithm=dfs):
+    """
+    Flattens many nested structures that mostly share a few shapes, storing each distinct structure pattern once
+
+    Returns (patterns, pattern_ids, columns):
+
+    - patterns is the list of distinct structure patterns, in order of first appearance
+    - pattern_ids is an array with the index in patterns of each record's pattern
+    - columns holds, for each pattern, one list per flat position with the value at that position of every record of that pattern, in record order
+
+    >>> patterns, pattern_ids, columns = flatten_many([[1,[2]],[3,4],[5,[6]]])
+    >>> patterns
+    ['1[1]', '2']
+    >>> list(pattern_ids)
+    [0, 1, 0]
+    >>> columns
+    [[[1, 5], [2, 6]], [[3], [4]]]
+    >>> deflatten_many(patterns, pattern_ids, columns)
+    [[1, [2]], [3, 4], [5, [6]]]
+
+    """
+    pattern_numbers = {}
+    patterns = []
+    pattern_ids = array('q')
+    columns = []
+    for record in records:
+        structure_pattern,flat_list = flatten(record,algorithm)
+        pattern_id = pattern_numbers.get(structure_pattern)
+        if pattern_id is None:
+            pattern_id = pattern_numbers[structure_pattern] = len(patterns)
+            patterns.append(structure_pattern)
+            columns.append([[] for _ in flat_list])
+        pattern_ids.append(pattern_id)
+        for column,value in zip(columns[pattern_id],flat_list):
+            column.append(value)
+    return (patterns,pattern_ids,columns)
+
+def deflatten_many(patterns,pattern_ids,columns):
+    """
+    Reverses flatten_many, returning the list of nested structures
+
+    Each pattern is parsed once for all of its records.
+    """
+    structure_directives = []
+    rows = []
+    for structure_pattern,pattern_columns in zip(patterns,columns):
+        directives = parse_pattern(structure_pattern)
+        if NestDirective.REPEAT in directives:
+            directives = _expand_directives(directives)
+        structure_directives.append(directives)
+        rows.append(zip(*pattern_columns) if len(pattern_columns) > 0 else repeat(()))
+    records = []
+    for pattern_id in pattern_ids:
+        row = next(rows[pattern_id],None)
+        if row is None:
+            raise Exception('pattern_ids refers to more records of a pattern than its columns contain')
+        records.append(_deflatten_values(structure_directives[pattern_id],iter(row)))
+    return records
+
+class NestedView:
+    """
+    A read-only view of the nested structure described by a structure pattern (dfs or bfs) and a flat list, built without deflattening
+
+    Indexing, len and iteration resolve positions through the compiled pattern.
+    Nested lists come back as NestedView objects and values are read from the flat list on access.
+    A tuple index such as view[1,2,0] is the same as view[1][2][0].
+
+    Slicing returns a slice of the flat list when the sliced range is a single run of consecutive values (step 1), otherwise a list of values and NestedView objects.
+    When the flat list is a buffer (array.array, bytes, ...) it is accessed through a memoryview, and numpy arrays are used as is, so such slices do not copy.
+
+    >>> view = NestedView('1[2[2[2]2]2]1', [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12])
+    >>> len(view)
+    3
+    >>> view[1][2][0]
+    4
+    >>> view[1,2,2,1]
+    7
+    >>> view[1][2]
+    NestedView([4, 5, [6, 7], 8, 9])
+    >>> view[1][2][3:5]
+    [8, 9]
+    >>> NestedView('1*1|2*2|2*2|2', [1, 12, 2, 3, 10, 11, 4, 5, 8, 9, 6, 7]).tolist()
+    [1, [2, 3, [4, 5, [6, 7], 8, 9], 10, 11], 12]
+    >>> NestedView('2[3]',array('d',[1,2,3,4,5]))[2][0:2].tolist()
+    [3.0, 4.0]
+
+    """
+    def __init__(self,structure_pattern,flat_list,_node=None):
+        self.structure_pattern = compile_pattern(structure_pattern)
+        if _node is None:
+            if len(flat_list) < self.structure_pattern.size:
+                raise Exception('structure_pattern implies more values than flat_list contains')
+            if len(flat_list) > self.structure_pattern.size:
+                raise Exception('flat_list has more data than structure_pattern implies')
+            if not isinstance(flat_list,(list,tuple,memoryview)) and not (_numpy is not None and isinstance(flat_list,_numpy.ndarray)):
+                try:
+                    flat_list = memoryview(flat_list)
+                except TypeError:
+                    pass
+            _node = self.structure_pattern._top
+        self.flat_list = flat_list
+        self._node = _node
+
+    def __len__(self):
+        return self._node.length
+
+    def _entry(self,position,index):
+        entry = self._node.entries[position]
+        if isinstance(entry,_PatternNode):
+            return NestedView(self.structure_pattern,self.flat_list,entry)
+        return self.flat_list[self.structure_pattern._run_flat[entry] + index - self._node.starts[position]]
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            start,stop,step = index.indices(self._node.length)
+            if step == 1 and start < stop:
+                position = bisect_right(self._node.starts,start)-1
+                entry = self._node.entries[position]
+                if not isinstance(entry,_PatternNode) and stop <= self._node.starts[position] + self.structure_pattern._run_counts[entry]:
+                    flat_start = self.structure_pattern._run_flat[entry] + start - self._node.starts[position]
+                    return self.flat_list[flat_start:flat_start+stop-start]
+            return [self[i] for i in range(start,stop,step)]
+        if isinstance(index,tuple):
+            view = self
+            for i in index:
+                if not isinstance(view,NestedView):
+                    raise IndexError('NestedView index has too many levels')
+                view = view[i]
+            return view
+        if index < 0:
+            index += self._node.length
+        if not 0 <= index < self._node.length:
+            raise IndexError('NestedView index out of range')
+        return self._entry(bisect_right(self._node.starts,index)-1,index)
+
+    def __iter__(self):
+        run_flat = self.structure_pattern._run_flat
+        run_counts = self.structure_pattern._run_counts
+        for entry in self._node.entries:
+            if isinstance(entry,_PatternNode):
+                yield NestedView(self.structure_pattern,self.flat_list,entry)
+            else:
+                for flat_index in range(run_flat[entry],run_flat[entry]+run_counts[entry]):
+                    yield self.flat_list[flat_index]
+
+    def tolist(self):
+        """
+        Materializes the viewed nested structure as nested lists (as deflatten does)
+        """
+        return [(item.tolist() if isinstance(item,NestedView) else item) for item in self]
+
+    def __repr__(self):
+        return 'NestedView('+repr(self.tolist())+')'
+
+def _compiled_or_directives(structure_pattern):
+    """
+    Returns the StructurePattern of a pattern if it is compiled or cached (or has repeats), otherwise its parsed directives, for a single lookup by scanning
+    """
+    if isinstance(structure_pattern,StructurePattern):
+        return structure_pattern
+    compiled = pattern_cache.compiled(structure_pattern)
+    if compiled is not None:
+        return compiled
+    structure_directives = parse_pattern(structure_pattern)
+    if NestDirective.REPEAT in structure_directives:
+        return StructurePattern(structure_pattern)
+    return structure_directives
+
 def get_nested_indices(structure_pattern,flat_index):
     """
     Given a structure pattern and an index into the flat list, return the corresponding sequence of indices identifying the position in the nested structure.
 
     A negative flat index works from the end of the flat list
 
+    The structure pattern is compiled into a StructurePattern, kept in pattern_cache for later calls.
+    A pattern that is not cached (too long, or the cache is disabled) is scanned up to the flat index instead of being compiled for a single lookup.
+    Pass a StructurePattern (see compile_pattern) to look up many indices against the same pattern without the cache lookup.
+
     >>> get_nested_indices('1[2[2[2]2]2]1',0)
     [0]
     >>> get_nested_indices('1[2[2[2]2]2]1',1)
@@ -239,49 +2339,71 @@ def get_nested_indices(structure_pattern,flat_index):
     [2]
 
     """
-    nest_indices = [0]
+    compiled = _compiled_or_directives(structure_pattern)
+    if isinstance(compiled,StructurePattern):
+        return compiled.get_nested_indices(flat_index)
+    #the nested indices of the current list are kept as a chain of (parent chain, index in parent) pairs, so that queueing or entering a list is O(1)
+    chain = None
+    index = 0
     current_flat_index = 0
     nest_queue = deque()
-    structure_directives = parse_pattern(structure_pattern)
+    #for a negative flat index, the runs holding the last -flat_index values, as (flat start, count, chain, index)
+    tail_runs = deque()
     alg = None
-    if flat_index < 0:
-        flat_index += sum(item for item in structure_directives if isinstance(item,int))
-    for directive in structure_directives:
+    for directive in compiled:
         if directive is NestDirective.DFS_PUSH:
             if alg is bfs:
                 raise Exception('Structure pattern contains both dfs and bfs tokens')
             alg = dfs
-            nest_indices.append(0)
-        elif directive is NestDirective.DFS_POP: 
+            chain = (chain,index)
+            index = 0
+        elif directive is NestDirective.DFS_POP:
             if alg is bfs:
                 raise Exception('Structure pattern contains both dfs and bfs tokens')
             alg = dfs
-            nest_indices.pop()
-            nest_indices[-1] += 1
-        elif directive is NestDirective.BFS_QUEUE: 
+            if chain is None:
+                raise Exception('Structure pattern contains imbalanced directive tokens')
+            chain,index = chain[0],chain[1]+1
+        elif directive is NestDirective.BFS_QUEUE:
             if alg is dfs:
                 raise Exception('Structure pattern contains both dfs and bfs tokens')
             alg = bfs
-            nest_queue.append(nest_indices[:])
-            nest_indices[-1] += 1
-            
-
-        elif directive is NestDirective.BFS_SERVE: 
+            nest_queue.append((chain,index))
+            index += 1
+        elif directive is NestDirective.BFS_SERVE:
             if alg is dfs:
                 raise Exception('Structure pattern contains both dfs and bfs tokens')
-            nest_indices = nest_queue.popleft()
-            nest_indices.append(0)
+            if len(nest_queue) == 0:
+                raise Exception('Structure pattern contains imbalanced directive tokens')
+            chain = nest_queue.popleft()
+            index = 0
         else:
-            #is a number 
-            if current_flat_index <= flat_index < (current_flat_index + directive):
-                nest_indices[-1] += (flat_index-current_flat_index)
-                return nest_indices
-            else:
-                current_flat_index += directive
-                nest_indices[-1] += directive
+            #is a number
+            if flat_index < 0:
+                tail_runs.append((current_flat_index,directive,chain,index))
+                while tail_runs[0][0] + tail_runs[0][1] <= current_flat_index + directive + flat_index:
+                    tail_runs.popleft()
+            elif current_flat_index <= flat_index < (current_flat_index + directive):
+                return _chain_indices(chain,index + flat_index - current_flat_index)
+            current_flat_index += directive
+            index += directive
+    if flat_index < 0:
+        flat_index += current_flat_index
+        for start,count,chain,index in tail_runs:
+            if start <= flat_index < start + count:
+                return _chain_indices(chain,index + flat_index - start)
     raise Exception('flat index exceeds size implied by structure pattern')
 
-
+def _chain_indices(chain,index):
+    """
+    Returns the nested indices of a chain of (parent chain, index in parent) pairs followed by index
+    """
+    nest_indices = [index]
+    while chain is not None:
+        chain,index = chain
+        nest_indices.append(index)
+    nest_indices.reverse()
+    return nest_indices
 
 
 def get_flat_index(structure_pattern,nest_indices):
@@ -308,42 +2430,58 @@ def get_flat_index(structure_pattern,nest_indices):
     11
 
     """
-    current_nest_indices = [0]
+    compiled = _compiled_or_directives(structure_pattern)
+    if isinstance(compiled,StructurePattern):
+        return compiled.get_flat_index(nest_indices)
+    nest_indices = list(nest_indices)
+    last = len(nest_indices)-1
+    if last < 0:
+        raise Exception('The provided nest indices do not exist in the structure pattern')
+    #matched tells whether the nested indices of the current list are a prefix of nest_indices, so each run is checked in O(1)
+    depth = 0
+    matched = True
+    index = 0
     flat_index = 0
+    nest_stack = []
     nest_queue = deque()
-    structure_directives = parse_pattern(structure_pattern)
     alg = None
-    for directive in structure_directives:
+    for directive in compiled:
         if directive is NestDirective.DFS_PUSH:
             if alg is bfs:
                 raise Exception('Structure pattern contains both dfs and bfs tokens')
             alg = dfs
-            current_nest_indices.append(0)
-        elif directive is NestDirective.DFS_POP: 
+            nest_stack.append((index,matched))
+            matched = matched and depth < last and index == nest_indices[depth]
+            depth += 1
+            index = 0
+        elif directive is NestDirective.DFS_POP:
             if alg is bfs:
                 raise Exception('Structure pattern contains both dfs and bfs tokens')
             alg = dfs
-            current_nest_indices.pop()
-            current_nest_indices[-1] += 1
-        elif directive is NestDirective.BFS_QUEUE: 
+            if len(nest_stack) == 0:
+                raise Exception('Structure pattern contains imbalanced directive tokens')
+            index,matched = nest_stack.pop()
+            index += 1
+            depth -= 1
+        elif directive is NestDirective.BFS_QUEUE:
             if alg is dfs:
                 raise Exception('Structure pattern contains both dfs and bfs tokens')
             alg = bfs
-            nest_queue.append(current_nest_indices[:])
-            current_nest_indices[-1] += 1
-
-        elif directive is NestDirective.BFS_SERVE: 
+            nest_queue.append((depth+1,matched and depth < last and index == nest_indices[depth]))
+            index += 1
+        elif directive is NestDirective.BFS_SERVE:
             if alg is dfs:
                 raise Exception('Structure pattern contains both dfs and bfs tokens')
-            current_nest_indices = nest_queue.popleft()
-            current_nest_indices.append(0)
+            if len(nest_queue) == 0:
+                raise Exception('Structure pattern contains imbalanced directive tokens')
+            depth,matched = nest_queue.popleft()
+            index = 0
         else:
-            #is a number 
-            if current_nest_indices[:-1] == nest_indices[:-1] and (current_nest_indices[-1] <= nest_indices[-1] < (current_nest_indices[-1]+directive)):
-                return flat_index + (nest_indices[-1] - current_nest_indices[-1])
-            else:
-                current_nest_indices[-1] += directive
-                flat_index += directive
+            #is a number
+            if matched and depth == last and index <= nest_indices[last] < index + directive:
+                return flat_index + nest_indices[last] - index
+            index += directive
+            flat_index += directive
     raise Exception('The provided nest indices do not exist in the structure pattern')
 
 def convert_dfs_to_bfs(dfs_pattern):
@@ -354,6 +2492,17 @@ def convert_dfs_to_bfs(dfs_pattern):
     '1*3*|2*3|2|1'
 
     """
+    if isinstance(dfs_pattern,StructurePattern):
+        if not is_dfs_pattern(dfs_pattern):
+            raise Exception('Provided pattern has bfs tokens in it')
+        return dfs_pattern.as_bfs()
+    if isinstance(dfs_pattern,(bytes,bytearray)):
+        return encode_pattern(convert_dfs_to_bfs(compile_pattern(dfs_pattern)))
+    if not is_dfs_pattern(dfs_pattern):
+        raise Exception('Provided pattern has bfs tokens in it')
+    compiled = pattern_cache.compiled(dfs_pattern)
+    if compiled is not None or directive_token_map[NestDirective.REPEAT] in dfs_pattern:
+        return convert_dfs_to_bfs(compiled or StructurePattern(dfs_pattern)).pattern
     start = []
     under_construction = deque([start])
     level = 0
@@ -392,6 +2541,17 @@ def convert_bfs_to_dfs(bfs_pattern):
     '1[2[1]3]3[2]'
 
     """
+    if isinstance(bfs_pattern,StructurePattern):
+        if not is_bfs_pattern(bfs_pattern):
+            raise Exception('Provided pattern has dfs tokens in it')
+        return bfs_pattern.as_dfs()
+    if isinstance(bfs_pattern,(bytes,bytearray)):
+        return encode_pattern(convert_bfs_to_dfs(compile_pattern(bfs_pattern)))
+    if not is_bfs_pattern(bfs_pattern):
+        raise Exception('Provided pattern has dfs tokens in it')
+    compiled = pattern_cache.compiled(bfs_pattern)
+    if compiled is not None or directive_token_map[NestDirective.REPEAT] in bfs_pattern:
+        return convert_bfs_to_dfs(compiled or StructurePattern(bfs_pattern)).pattern
     top = []
     target = top
     queue = deque()
@@ -431,11 +2591,19 @@ def is_bfs_pattern(pattern):
     """
     Checks if a given pattern can be interpreted as a breadth-first search pattern
     """
+    if isinstance(pattern,StructurePattern):
+        pattern = pattern.pattern
+    if isinstance(pattern,(bytes,bytearray)):
+        return not _parse_encoded_header(pattern) & ENCODED_DFS_FLAG
     return not directive_token_map[NestDirective.DFS_PUSH] in pattern and not directive_token_map[NestDirective.DFS_POP] in pattern
 def is_dfs_pattern(pattern):
     """
     Checks if a given pattern can be interpreted as a depth-first search pattern
     """
+    if isinstance(pattern,StructurePattern):
+        pattern = pattern.pattern
+    if isinstance(pattern,(bytes,bytearray)):
+        return not _parse_encoded_header(pattern) & ENCODED_BFS_FLAG
     return not directive_token_map[NestDirective.BFS_QUEUE] in pattern and not directive_token_map[NestDirective.BFS_SERVE] in pattern
 def as_bfs_pattern(pattern):
     """
@@ -459,17 +2627,317 @@ def convert_flat_index_dfs_to_bfs(pattern,dfs_flat_index):
     11
 
     """
-    dfs_pattern = as_dfs_pattern(pattern)
-    nest_indices = get_nested_indices(dfs_pattern,dfs_flat_index)
-    bfs_pattern = convert_dfs_to_bfs(dfs_pattern)
-    return get_flat_index(bfs_pattern,nest_indices)
+    dfs_pattern = compile_pattern(pattern).as_dfs()
+    return dfs_pattern.as_bfs().get_flat_index(dfs_pattern.get_nested_indices(dfs_flat_index))
 def convert_flat_index_bfs_to_dfs(pattern,bfs_flat_index):
     """
     Calculates a dfs flat index from a bfs one
     >>> convert_flat_index_bfs_to_dfs('1[2[1]3]3[2]',11)
     3
     """
-    bfs_pattern = as_bfs_pattern(pattern)
-    nest_indices = get_nested_indices(bfs_pattern,bfs_flat_index)
-    dfs_pattern = convert_bfs_to_dfs(bfs_pattern)
-    return get_flat_index(dfs_pattern,nest_indices)
+    bfs_pattern = compile_pattern(pattern).as_bfs()
+    return bfs_pattern.as_dfs().get_flat_index(bfs_pattern.get_nested_indices(bfs_flat_index))
+
+def get_nested_indices_batch(structure_pattern,flat_indices):
+    """
+    Batch form of get_nested_indices for a sequence (or numpy array) of flat indices
+
+    Returns a 2-D array with one row of nested indices per flat index.
+    Rows are padded on the right with -1 to the length of the deepest row.
+    A numpy array is returned when numpy is installed, otherwise a list of lists.
+
+    >>> [[int(i) for i in row] for row in get_nested_indices_batch('1[2[2[2]2]2]1',[0,5,-2])]
+    [[0, -1, -1, -1], [1, 2, 2, 0], [1, 4, -1, -1]]
+    """
+    return compile_pattern(structure_pattern).get_nested_indices_batch(flat_indices)
+
+def get_flat_index_batch(structure_pattern,nest_indices):
+    """
+    Batch form of get_flat_index
+
+    nest_indices is a 2-D array of nested indices padded on the right with -1, as returned by get_nested_indices_batch, or a sequence of nested index sequences of any lengths.
+    A numpy array is returned when numpy is installed, otherwise a list.
+
+    >>> [int(i) for i in get_flat_index_batch('1[2[2[2]2]2]1',[[0,-1,-1,-1],[1,2,2,0],[1,4]])]
+    [0, 5, 10]
+    """
+    return compile_pattern(structure_pattern).get_flat_index_batch(nest_indices)
+
+def convert_flat_index_dfs_to_bfs_batch(pattern,dfs_flat_indices):
+    """
+    Batch form of convert_flat_index_dfs_to_bfs
+
+    The pattern is converted once and each index is mapped through the run containing it, without building nested indices.
+
+    >>> [int(i) for i in convert_flat_index_dfs_to_bfs_batch('1[2[1]3]3[2]',[0,3,8])]
+    [0, 11, 2]
+    """
+    dfs_pattern = compile_pattern(pattern).as_dfs()
+    return dfs_pattern._convert_flat_indices_batch(dfs_pattern.as_bfs(),dfs_flat_indices)
+
+def convert_flat_index_bfs_to_dfs_batch(pattern,bfs_flat_indices):
+    """
+    Batch form of convert_flat_index_bfs_to_dfs
+
+    >>> [int(i) for i in convert_flat_index_bfs_to_dfs_batch('1[2[1]3]3[2]',[0,11,2])]
+    [0, 3, 8]
+    """
+    bfs_pattern = compile_pattern(pattern).as_bfs()
+    return bfs_pattern._convert_flat_indices_batch(bfs_pattern.as_dfs(),bfs_flat_indices)
+
+def get_dfs_to_bfs_permutation(pattern):
+    """
+    Returns an array.array perm such that bfs_flat_list[i] == dfs_flat_list[perm[i]]
+
+    The permutation is cached on the compiled pattern, so compile the pattern once (see compile_pattern) when reordering many flat lists of the same shape.
+    The returned array is a copy and may be modified freely.
+
+    >>> list(get_dfs_to_bfs_permutation('1[2[1]3]3[2]'))
+    [0, 7, 8, 9, 1, 2, 4, 5, 6, 10, 11, 3]
+    """
+    return compile_pattern(pattern).as_bfs().get_permutation()
+
+def get_bfs_to_dfs_permutation(pattern):
+    """
+    Returns an array.array perm such that dfs_flat_list[i] == bfs_flat_list[perm[i]]
+
+    >>> list(get_bfs_to_dfs_permutation('1[2[1]3]3[2]'))
+    [0, 4, 5, 11, 6, 7, 8, 1, 2, 3, 9, 10]
+    """
+    return compile_pattern(pattern).as_dfs().get_permutation()
+
+def apply_permutation(permutation,flat_list):
+    """
+    Returns the items of flat_list taken in the order given by permutation
+
+    A numpy array gives a numpy array, an array.array gives an array.array of the same typecode and anything else gives a list
+
+    >>> apply_permutation([2,0,1],array('d',[1.0,2.0,3.0]))
+    array('d', [3.0, 1.0, 2.0])
+    """
+    if len(permutation) != len(flat_list):
+        raise Exception('flat_list and permutation have different sizes')
+    if _numpy is not None and isinstance(flat_list,_numpy.ndarray):
+        return flat_list[_numpy.asarray(permutation,dtype=_numpy.int64)]
+    if isinstance(flat_list,array):
+        return array(flat_list.typecode,[flat_list[i] for i in permutation])
+    return [flat_list[i] for i in permutation]
+
+def reorder_dfs_to_bfs(pattern,dfs_flat_list):
+    """
+    Reorders a flat list in dfs order into bfs order without deflattening
+
+    >>> reorder_dfs_to_bfs('1[2[2[2]2]2]1',[1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12])
+    [1, 12, 2, 3, 10, 11, 4, 5, 8, 9, 6, 7]
+    """
+    return apply_permutation(compile_pattern(pattern).as_bfs()._get_permutation(),dfs_flat_list)
+
+def reorder_bfs_to_dfs(pattern,bfs_flat_list):
+    """
+    Reorders a flat list in bfs order into dfs order without deflattening
+
+    >>> reorder_bfs_to_dfs('1*1|2*2|2*2|2',[1, 12, 2, 3, 10, 11, 4, 5, 8, 9, 6, 7])
+    [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
+    """
+    return apply_permutation(compile_pattern(pattern).as_dfs()._get_permutation(),bfs_flat_list)
+
+def get_subtree(structure_pattern,nest_indices):
+    """
+    Given a structure pattern and the nested indices of a nested list, returns (sub-pattern, flat range) for that subtree without deflattening
+
+    For a dfs pattern the values of the subtree are contiguous and the flat range is a (start, stop) tuple.
+    For a bfs pattern the flat range is a list of (start, stop) tuples whose slices, concatenated in order, are the bfs flat list of the subtree.
+    The sub-pattern has the same form as structure_pattern (string, StructurePattern or binary encoding).
+
+    >>> get_subtree('1[2[2[2]2]2]1',[1,2])
+    ('2[2]2', (3, 9))
+    >>> get_subtree('1*3*|2*3|2|1',[1])
+    ('2*3|1', [(4, 9), (11, 12)])
+    """
+    sub_pattern,flat_range = compile_pattern(structure_pattern).get_subtree(nest_indices)
+    return (_same_kind(structure_pattern,sub_pattern),flat_range)
+
+def extract_subtree(structure_pattern,flat_list,nest_indices):
+    """
+    Returns (sub-pattern, sub flat list) of the subtree at the nested indices by slicing flat_list (see get_subtree)
+
+    For a dfs pattern the sub flat list is a single slice of flat_list, so numpy arrays and memoryviews are not copied.
+
+    >>> extract_subtree('1*1|2*2|2*2|2',[1, 12, 2, 3, 10, 11, 4, 5, 8, 9, 6, 7],[1,2])
+    ('2*2|2', [4, 5, 8, 9, 6, 7])
+    """
+    sub_pattern,flat_range = get_subtree(structure_pattern,nest_indices)
+    if isinstance(flat_range,tuple):
+        return (sub_pattern,flat_list[flat_range[0]:flat_range[1]])
+    parts = [flat_list[start:stop] for start,stop in flat_range]
+    if _numpy is not None and isinstance(flat_list,_numpy.ndarray):
+        return (sub_pattern,_numpy.concatenate(parts) if len(parts) > 0 else flat_list[0:0])
+    sub_flat_list = flat_list[0:0]
+    if isinstance(sub_flat_list,memoryview):
+        sub_flat_list = sub_flat_list.tolist()
+    for part in parts:
+        sub_flat_list += part
+    return (sub_pattern,sub_flat_list)
+
+def _pattern_string(structure_pattern):
+    """
+    Returns the pattern string of a pattern string, StructurePattern or binary encoded pattern
+    """
+    if isinstance(structure_pattern,StructurePattern):
+        return structure_pattern.pattern
+    if isinstance(structure_pattern,(bytes,bytearray)):
+        return decode_pattern(structure_pattern)
+    return structure_pattern
+
+def _same_kind(template,pattern_string):
+    """
+    Returns pattern_string as the same kind of pattern as template (string, StructurePattern or binary encoding)
+    """
+    if isinstance(template,StructurePattern):
+        return StructurePattern(pattern_string)
+    if isinstance(template,(bytes,bytearray)):
+        return encode_pattern(pattern_string)
+    return pattern_string
+
+def _patterns_algorithm(patterns,algorithm=None):
+    """
+    Returns dfs or bfs according to the tokens in the patterns, or algorithm (default dfs) if they have no nest directives
+    """
+    found = set()
+    for pattern in patterns:
+        if not is_dfs_pattern(pattern):
+            found.add(bfs)
+        if not is_bfs_pattern(pattern):
+            found.add(dfs)
+    if algorithm is not None:
+        found.add(algorithm)
+    if len(found) > 1:
+        raise Exception('Structure patterns contain both dfs and bfs tokens')
+    return found.pop() if len(found) > 0 else dfs
+
+_leading_repeat_regex = re.compile('[0-9]+'+re.escape(directive_token_map[NestDirective.REPEAT]))
+_trailing_run_regex = re.compile('[0-9]$')
+
+def _split_leading_repeat(structure_pattern):
+    """
+    Writes the first copy of a repeated nested list at the start of a pattern separately, so that the pattern can follow a run of values
+    """
+    top,algorithm,run_nodes,run_counts,run_offsets,repeated = _parse_tree(parse_pattern(structure_pattern))
+    repeated_node = top.entries[0]
+    first = _PatternNode(top,0)
+    first.entries = repeated_node.entries
+    repeated_node.repeat -= 1
+    top.entries.insert(0,first)
+    return _render_pattern(top,run_counts,algorithm)
+
+def concatenate_patterns(patterns,algorithm=None):
+    """
+    Returns the pattern of the list holding the top level items of every pattern in turn, without deflattening
+
+    The patterns must all be dfs or all be bfs; algorithm picks the form for patterns without nest directives (default dfs).
+    For dfs, the flat list of the result is the concatenation of the flat lists.
+    For bfs, the levels of the patterns are interleaved, so use concatenate_flattened to get the matching flat list.
+
+    >>> concatenate_patterns(['1[2]1','2[1]'])
+    '1[2]3[1]'
+    >>> concatenate_patterns(['1*1|2','2*|1'])
+    '1*3*|2|1'
+    >>> concatenate_patterns(['1','3x[2]'])
+    '1[2]2x[2]'
+    """
+    patterns = list(patterns)
+    if len(patterns) == 0:
+        return ''
+    strings = [_pattern_string(pattern) for pattern in patterns]
+    previous = ''
+    for i,string in enumerate(strings):
+        if _leading_repeat_regex.match(string) and _trailing_run_regex.search(previous):
+            strings[i] = _split_leading_repeat(string)
+        if string != '':
+            previous = string.split(directive_token_map[NestDirective.BFS_SERVE])[0]
+    if _patterns_algorithm(strings,algorithm) is dfs:
+        return _same_kind(patterns[0],_join_top_level_patterns(strings))
+    levels = _join_bfs_levels([_split_bfs_levels(string) for string in strings])
+    return _same_kind(patterns[0],directive_token_map[NestDirective.BFS_SERVE].join([group for level in levels for group in level]))
+
+def nest_pattern(structure_pattern,algorithm=None):
+    """
+    Returns the pattern of a list whose only item is the structure of structure_pattern
+
+    The flat list is unchanged, in both dfs and bfs order.
+
+    >>> nest_pattern('1[2]1')
+    '[1[2]1]'
+    >>> nest_pattern('1*1|2')
+    '*|1*1|2'
+    """
+    return stack_patterns([structure_pattern],algorithm)
+
+def stack_patterns(patterns,algorithm=None):
+    """
+    Returns the pattern of a list with one nested list item per pattern, holding the structure of that pattern
+
+    For dfs, the flat list of the result is the concatenation of the flat lists.
+    For bfs, use stack_flattened to get the matching flat list.
+
+    >>> stack_patterns(['1[2]1','2'])
+    '[1[2]1][2]'
+    >>> stack_patterns(['1*1|2','2'])
+    '**|1*1|2|2'
+    """
+    patterns = list(patterns)
+    strings = [_pattern_string(pattern) for pattern in patterns]
+    if _patterns_algorithm(strings,algorithm) is dfs:
+        push = directive_token_map[NestDirective.DFS_PUSH]
+        pop = directive_token_map[NestDirective.DFS_POP]
+        stacked = ''.join([push+string+pop for string in strings])
+    else:
+        levels = [[directive_token_map[NestDirective.BFS_QUEUE]*len(strings)]] + _interleave_levels([_split_bfs_levels(string) for string in strings])
+        stacked = directive_token_map[NestDirective.BFS_SERVE].join([group for level in levels for group in level])
+    return _same_kind(patterns[0],stacked) if len(patterns) > 0 else stacked
+
+def _bfs_flat_list(split_flattened):
+    """
+    Interleaves the per level values of split bfs flattened structures (see _split_bfs_flattened)
+    """
+    flat_list = []
+    for level_values in _interleave_levels([level_values for levels,level_values in split_flattened]):
+        flat_list.extend(level_values)
+    return flat_list
+
+def concatenate_flattened(flattened,algorithm=None):
+    """
+    Given (structure pattern, flat list) pairs, returns the (structure pattern, flat list) of the concatenation of their top levels
+
+    This is flatten applied to the concatenation of the deflattened structures, computed from the patterns alone.
+
+    >>> concatenate_flattened([('1*1|2',[0,1,2,3]),('2*|1',[4,5,6])])
+    ('1*3*|2|1', [0, 1, 4, 5, 2, 3, 6])
+    """
+    flattened = list(flattened)
+    patterns = [structure_pattern for structure_pattern,flat_list in flattened]
+    structure_pattern = concatenate_patterns(patterns,algorithm)
+    if _patterns_algorithm(patterns,algorithm) is dfs:
+        flat_list = []
+        for pattern,pattern_flat_list in flattened:
+            flat_list.extend(pattern_flat_list)
+        return (structure_pattern,flat_list)
+    return (structure_pattern,_bfs_flat_list([_split_bfs_flattened(_pattern_string(pattern),flat_list) for pattern,flat_list in flattened]))
+
+def stack_flattened(flattened,algorithm=None):
+    """
+    Given (structure pattern, flat list) pairs, returns the (structure pattern, flat list) of a list holding each of their structures as a nested list
+
+    >>> stack_flattened([('1*1|2',[0,1,2,3]),('2',[4,5])])
+    ('**|1*1|2|2', [0, 1, 4, 5, 2, 3])
+    """
+    flattened = list(flattened)
+    patterns = [structure_pattern for structure_pattern,flat_list in flattened]
+    structure_pattern = stack_patterns(patterns,algorithm)
+    if _patterns_algorithm(patterns,algorithm) is dfs:
+        flat_list = []
+        for pattern,pattern_flat_list in flattened:
+            flat_list.extend(pattern_flat_list)
+        return (structure_pattern,flat_list)
+    #the stacking list adds no values, so the levels of values are the same as for concatenation
+    return (structure_pattern,_bfs_flat_list([_split_bfs_flattened(_pattern_string(pattern),flat_list) for pattern,flat_list in flattened]))
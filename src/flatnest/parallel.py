@@ -0,0 +1,56 @@
+"""
+This module flattens nested structures with many top level items in parallel using concurrent.futures
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from .flatnest import NestDirective, bfs, concatenate_flattened, dfs, directive_token_map, flatten, _bfs_flat_list, _join_bfs_levels, _split_bfs_flattened
+
+def _flatten_chunk(chunk,algorithm):
+    """
+    Flattens a list of consecutive top level items
+
+    For bfs, the pattern and flat list are returned split by level so that the chunks can be interleaved
+    """
+    structure_pattern,flat_list = flatten(chunk,algorithm)
+    if algorithm is dfs:
+        return (structure_pattern,flat_list)
+    return _split_bfs_flattened(structure_pattern,flat_list)
+
+def parallel_flatten(nested_structure,algorithm=dfs,workers=None,executor=None,chunk_count=None):
+    """
+    Same as flatten, with the top level items split into chunks that are flattened concurrently
+
+    The chunk results are merged into exactly the output of flatten: dfs patterns are concatenated and bfs patterns are interleaved level by level.
+
+    workers is the number of processes of the ProcessPoolExecutor created when no executor is given (default os.cpu_count()).
+    executor may be any concurrent.futures executor, e.g. a ThreadPoolExecutor, and is not shut down.
+    chunk_count is the number of chunks (default 4 per worker).
+
+    Items sent to a process pool must be picklable; the cost of sending them is only worth paying for large structures.
+
+    >>> from concurrent.futures import ThreadPoolExecutor
+    >>> with ThreadPoolExecutor(2) as executor:
+    ...     parallel_flatten([1,[2,3,[4,5,[6,7],8,9],10,11],12],bfs,executor=executor,chunk_count=3)
+    ('1*1|2*2|2*2|2', [1, 12, 2, 3, 10, 11, 4, 5, 8, 9, 6, 7])
+
+    """
+    if algorithm not in [dfs,bfs]:
+        raise Exception('algorithm must be either the function dfs or the function bfs')
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunk_count is None:
+        chunk_count = 4*workers
+    chunk_size = max(1,-(-len(nested_structure)//chunk_count))
+    chunks = [list(nested_structure[start:start+chunk_size]) for start in range(0,len(nested_structure),chunk_size)]
+    if len(chunks) <= 1:
+        return flatten(nested_structure,algorithm)
+    if executor is None:
+        with ProcessPoolExecutor(workers) as process_executor:
+            results = list(process_executor.map(_flatten_chunk,chunks,[algorithm]*len(chunks)))
+    else:
+        results = list(executor.map(_flatten_chunk,chunks,[algorithm]*len(chunks)))
+    if algorithm is dfs:
+        return concatenate_flattened(results,dfs)
+    levels = _join_bfs_levels([levels for levels,level_values in results])
+    return (directive_token_map[NestDirective.BFS_SERVE].join([group for level in levels for group in level]),_bfs_flat_list(results))